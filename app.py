@@ -1,6 +1,7 @@
 
 
 import os
+import threading
 
 import dash
 import dash_auth
@@ -18,10 +19,26 @@ app.config.suppress_callback_exceptions = True
 app.css.append_css({'external_url': 'https://codepen.io/chriddyp/pen/bWLwgP.css'})
 # app.css.append_css({"external_url": "https://codepen.io/chriddyp/pen/brPBPO.css"}) # loading screen
 
-# Connect MongoDB
-user = os.environ.get('MONGOD_DURAMAT_USER')
-passwd = os.environ.get('MONGOD_DURAMAT_PASS')
-leftover = os.environ.get('MONGOD_DURAMAT_LEFTOVER')
-client = MongoClient('mongodb+srv://{}:{}@{}'.format(user, passwd, leftover))
+# Connect MongoDB lazily so importing the app never waits on the database
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Get the shared MongoDB client, creating it on first use.
+
+    Returns:
+        MongoClient
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                user = os.environ.get('MONGOD_DURAMAT_USER')
+                passwd = os.environ.get('MONGOD_DURAMAT_PASS')
+                leftover = os.environ.get('MONGOD_DURAMAT_LEFTOVER')
+                _client = MongoClient('mongodb+srv://{}:{}@{}'.format(user, passwd, leftover))
+    return _client
+
 
 server = app.server
@@ -0,0 +1,26 @@
+"""
+Write a local HDF5 snapshot of pvdata.appdata (metadata, performance data and rollups) for the dashboard.
+
+Serve it by setting DURAMAT_HDF5_SNAPSHOT to the output path.
+
+Usage:
+    python db_update/make_snapshot.py [output.h5]
+"""
+
+import os
+import sys
+
+from pymongo import MongoClient
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from degradation.backends import MongoBackend, write_hdf5_snapshot
+
+
+if __name__ == '__main__':
+    path = sys.argv[1] if len(sys.argv) > 1 else 'pvdata_snapshot.h5'
+    user = os.environ.get('MONGOD_DURAMAT_ADMIN_USER')
+    passwd = os.environ.get('MONGOD_DURAMAT_ADMIN_PASS')
+    leftover = os.environ.get('MONGOD_DURAMAT_LEFTOVER')
+    client = MongoClient('mongodb+srv://{}:{}@{}'.format(user, passwd, leftover))
+    n_systems = write_hdf5_snapshot(MongoBackend(client.pvdata.appdata), path)
+    print('Wrote {} systems to {}'.format(n_systems, path))
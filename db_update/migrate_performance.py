@@ -0,0 +1,24 @@
+"""
+Rewrite pickled (or older) `performance` fields in pvdata.appdata with the columnar encoding and add missing rollups.
+
+Usage:
+    python db_update/migrate_performance.py [float64|float32]
+"""
+
+import os
+import sys
+
+from pymongo import MongoClient
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from degradation.encoding import migrate_performance
+
+
+if __name__ == '__main__':
+    dtype = sys.argv[1] if len(sys.argv) > 1 else 'float64'
+    user = os.environ.get('MONGOD_DURAMAT_ADMIN_USER')
+    passwd = os.environ.get('MONGOD_DURAMAT_ADMIN_PASS')
+    leftover = os.environ.get('MONGOD_DURAMAT_LEFTOVER')
+    client = MongoClient('mongodb+srv://{}:{}@{}'.format(user, passwd, leftover))
+    n_migrated = migrate_performance(client.pvdata.appdata, dtype=dtype)
+    print('Migrated {} documents'.format(n_migrated))
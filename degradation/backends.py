@@ -0,0 +1,283 @@
+"""
+Storage backends for DBHandler.
+
+A backend answers two kinds of queries: system metadata, and encoded time-series fields (`performance` and the
+rollups, see encoding.py) for a list of system IDs.  MongoBackend reads the pvdata.appdata collection;
+HDF5Backend reads a local fleet snapshot written by `write_hdf5_snapshot`, so the dashboard can run without
+network round-trips.
+"""
+
+import os
+import time
+import threading
+
+import h5py
+import pandas as pd
+import numpy as np
+from pymongo.collection import Collection
+
+from .encoding import (RESOLUTIONS, SMOOTHERS, decode_performance, encoded_size, index_bounds, index_header,
+                       make_index, range_pipeline, rollup_field, slice_performance)
+from .metrics import BYTES_BUCKETS, Metrics
+
+
+# metadata fields used by the dashboard
+METADATA_FIELDS = ['ID', 'system_size (W)', 'latitude (deg)', 'longitude (deg)', 'system_name', 'state (abbr)',
+                   'county', 'active_days', 'climate', 'csd_rd', 'yoy_rd', 'ols_rd', 'updated_at']
+
+
+def _get_field(doc, field):
+    """Read a dotted field path from a (nested) document, None if absent."""
+    for key in field.split('.'):
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(key)
+    return doc
+
+
+class StorageBackend(object):
+    """
+    Interface of the storage used by DBHandler.
+
+    Implementations record 'query_seconds' (waiting on storage), 'decode_seconds' and 'bytes_read' in `metrics`.
+    """
+
+    metrics = None
+
+    def query_metadata(self, fields, updated_since=None):
+        """Get system metadata.
+
+        Parameters
+        ----------
+        fields: list
+            Metadata fields to return.
+        updated_since: datetime or None
+            Only return systems whose `updated_at` is later than this (None for all systems).
+
+        Returns
+        -------
+        metadata: pd.DataFrame
+            One row per system.
+        """
+        raise NotImplementedError
+
+    def query_performance(self, ids, field, start=None, end=None):
+        """Get one encoded time-series field for a group of systems.
+
+        Parameters
+        ----------
+        ids: list
+            System ID values.
+        field: str
+            Field holding encoded data (see encoding.rollup_field).
+        start, end: pd.Timestamp or None
+            Requested date range.
+
+        Returns
+        -------
+        systems: dict
+            Dictionary with {system_id: time-series} format.
+        missing: list
+            IDs for which the field is not stored.
+        """
+        raise NotImplementedError
+
+
+class MongoBackend(StorageBackend):
+    """
+    Storage in a MongoDB collection with one document per system.
+    """
+
+    def __init__(self, collection):
+        """Create instance.
+
+        Parameters:
+        ----------
+        collection: pymongo collection or function
+            System documents, or a function returning the collection (called on first use, so the backend can
+            be created before the database is reachable).
+        """
+        self._collection = collection
+        self.metrics = Metrics()
+
+    @property
+    def collection(self):
+        """pymongo collection, resolved on first use if a function was given."""
+        if not isinstance(self._collection, Collection) and callable(self._collection):
+            self._collection = self._collection()
+        return self._collection
+
+    def query_metadata(self, fields, updated_since=None):
+        query = {} if updated_since is None else {'updated_at': {'$gt': updated_since}}
+        projection = dict({i: 1 for i in fields}, _id=0)
+        return pd.DataFrame(list(self.collection.find(query, projection)))
+
+    def query_performance(self, ids, field, start=None, end=None):
+        t0 = time.time()
+        if start is None and end is None:
+            docs = ((doc['ID'], _get_field(doc, field))
+                    for doc in self.collection.find({'ID': {'$in': ids}}, {'ID': 1, field: 1, '_id': 0}))
+        else:
+            # only the yearly blocks overlapping the range are transferred
+            docs = ((doc['ID'], doc['data'] if doc['data'].get('blocks') is not None else doc.get('legacy'))
+                    for doc in self.collection.aggregate(range_pipeline(ids, field, start, end)))
+
+        systems = {}
+        t_query = t_decode = 0.
+        nbytes = 0
+        for system_id, raw in docs:
+            t1 = time.time()
+            t_query += t1 - t0
+            if raw is not None:
+                nbytes += encoded_size(raw)
+                systems[system_id] = slice_performance(decode_performance(raw), start, end)
+            t0 = time.time()
+            t_decode += t0 - t1
+        t_query += time.time() - t0
+
+        self.metrics.observe('query_seconds', t_query)
+        self.metrics.observe('decode_seconds', t_decode)
+        self.metrics.observe('bytes_read', nbytes, BYTES_BUCKETS)
+        self.metrics.incr('bytes_read_total', nbytes)
+        self.metrics.incr('systems_read', len(systems))
+        missing = [i for i in ids if i not in systems]
+        return systems, missing
+
+
+class HDF5Backend(StorageBackend):
+    """
+    Storage in a local HDF5 fleet snapshot.
+
+    Layout:
+        /metadata/<field>              one dataset per metadata field, one row per system
+        /systems/<ID>/<field path>     one dataset per encoded field (dots in the field path become groups),
+                                       with 'start', 'freq', 'tz' and 'name' attributes describing its time index
+    """
+
+    def __init__(self, path):
+        """Create instance.
+
+        Parameters:
+        ----------
+        path: str
+            Snapshot written by `write_hdf5_snapshot`.
+        """
+        self.path = path
+        self._file = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self.metrics = Metrics()
+
+    @property
+    def file(self):
+        """Read-only h5py file, (re)opened in each process."""
+        if self._file is None or self._pid != os.getpid():
+            self._file = h5py.File(self.path, 'r')
+            self._pid = os.getpid()
+        return self._file
+
+    def query_metadata(self, fields, updated_since=None):
+        data = {}
+        with self._lock:
+            group = self.file['metadata']
+            for name in fields:
+                if name not in group:
+                    continue
+                dset = group[name]
+                kind = dset.attrs.get('kind', '')
+                if kind == 'datetime':
+                    data[name] = pd.to_datetime(dset[()], unit='ns')
+                elif kind == 'str':
+                    values = [v.decode('utf-8') if isinstance(v, bytes) else v for v in dset[()]]
+                    data[name] = pd.Series(values).replace('', np.nan)
+                else:
+                    data[name] = dset[()]
+        metadata = pd.DataFrame(data)
+        if updated_since is not None and 'updated_at' in metadata:
+            metadata = metadata[metadata['updated_at'] > updated_since]
+        return metadata
+
+    def query_performance(self, ids, field, start=None, end=None):
+        systems = {}
+        path = field.replace('.', '/')
+        t_query = t_decode = 0.
+        nbytes = 0
+        with self._lock:
+            f = self.file
+            for i in ids:
+                name = 'systems/{}/{}'.format(i, path)
+                if name not in f:
+                    continue
+                t0 = time.time()
+                dset = f[name]
+                attrs = {key: (dset.attrs[key] or None) for key in ['start', 'freq', 'tz', 'name']}
+                index = make_index(attrs['start'], dset.shape[0], attrs['freq'], attrs['tz'])
+                # only read the requested part of the dataset
+                lo, hi = index_bounds(index, start, end)
+                t1 = time.time()
+                values = dset[lo: hi]
+                t2 = time.time()
+                systems[i] = pd.Series(values, index=index[lo: hi], name=attrs['name'])
+                t_decode += (t1 - t0) + (time.time() - t2)
+                t_query += t2 - t1
+                nbytes += values.nbytes
+
+        self.metrics.observe('query_seconds', t_query)
+        self.metrics.observe('decode_seconds', t_decode)
+        self.metrics.observe('bytes_read', nbytes, BYTES_BUCKETS)
+        self.metrics.incr('bytes_read_total', nbytes)
+        self.metrics.incr('systems_read', len(systems))
+        missing = [i for i in ids if i not in systems]
+        return systems, missing
+
+
+def write_hdf5_snapshot(source, path, chunk_size=100):
+    """Copy metadata, performance data and rollups of every system from a backend to an HDF5 snapshot.
+
+    Parameters
+    ----------
+    source: StorageBackend
+        Backend to copy (usually a MongoBackend).
+    path: str
+        Output file (overwritten).
+    chunk_size: int
+        Number of systems read per query.
+
+    Returns
+    -------
+    n_systems: int
+        Number of systems written.
+    """
+    metadata = source.query_metadata(METADATA_FIELDS)
+    fields = ['performance'] + [rollup_field(resolution, smoother)
+                                for resolution in RESOLUTIONS if resolution != 'daily' for smoother in SMOOTHERS]
+    ids = [int(i) for i in metadata['ID']]
+
+    with h5py.File(path, 'w') as f:
+        group = f.create_group('metadata')
+        for name in metadata.columns:
+            col = metadata[name]
+            if pd.api.types.is_datetime64_any_dtype(col):
+                dset = group.create_dataset(name, data=col.values.astype('datetime64[ns]').astype('int64'))
+                dset.attrs['kind'] = 'datetime'
+            elif pd.api.types.is_numeric_dtype(col):
+                group.create_dataset(name, data=col.values)
+            else:
+                dset = group.create_dataset(name, data=col.fillna('').astype(str).values.astype(object),
+                                            dtype=h5py.special_dtype(vlen=str))
+                dset.attrs['kind'] = 'str'
+
+        for i in range(0, len(ids), chunk_size):
+            chunk = ids[i: i + chunk_size]
+            for field in fields:
+                systems, _ = source.query_performance(chunk, field)
+                for system_id, series in systems.items():
+                    if not isinstance(series, pd.Series):
+                        continue
+                    header = index_header(series) if len(series) else {}
+                    dset = f.create_dataset('systems/{}/{}'.format(system_id, field.replace('.', '/')),
+                                            data=np.ascontiguousarray(series.values))
+                    for key in ['start', 'freq', 'tz', 'name']:
+                        dset.attrs[key] = header.get(key) or ''
+
+    return len(ids)
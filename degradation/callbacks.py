@@ -1,45 +1,305 @@
 
 
+import json
+import time
+import hashlib
+import functools
+
+import plotly
 import plotly.graph_objs as go
 from plotly import tools
 from dash.dependencies import Input, Output, State
 import dash_core_components as dcc
 import dash_html_components as html
 import plotly.figure_factory as ff
+try:
+    from dash.exceptions import PreventUpdate
+except ImportError:
+    # older dash: answered with an empty response (see add_callbacks), which the renderer does not apply
+    class PreventUpdate(Exception):
+        pass
 from scipy.stats import norm
 import numpy as np
 
 from . import degradation_functions as deg
+from .deg_dashboard import MAP_ZOOM, TABLE_COLUMNS, TABLE_PAGE_SIZE, make_map_figure, make_table
+from .utils import ResultCache, bin_rows, box_sample, box_stats, lod_resolution, zoom_range, zoom_rows
+
+# cell budget of the performance heatmap (about one cell per pixel of a full-width graph)
+HEATMAP_MAX_COLUMNS = 800
+HEATMAP_MAX_ROWS = 200
+# at most this many y-axis labels are drawn on the heatmap
+HEATMAP_MAX_LABELS = 40
 
 import pandas as pd
 
 
-def add_callbacks(app, db_handler):
+def add_callbacks(app, db_handler, result_cache=None):
     """Bind callbacks to app.
 
     Args:
         app (Dash.app): web application object
         db_handler (DBHander): object to perform db queries
+        result_cache (ResultCache): cache of figures for repeated selections (default: in-memory, 10 minute TTL)
 
     Returns:
         None
     """
-    metadata = db_handler.get_system_metadata()
+    if result_cache is None:
+        result_cache = ResultCache()
+    if PreventUpdate.__module__ == __name__:
+        # dash without PreventUpdate reports exceptions as errors; an empty response is ignored by the renderer
+        app.server.register_error_handler(PreventUpdate, lambda e: ('', 204))
+
+    def selection_key(site_ids):
+        """Key of a selection snapshot: the sorted selected IDs and the current metadata version.
+
+        The key is recomputed on every call (rather than read from the 'degradation-selection' div), so snapshots and
+        memoized figures made before a metadata refresh are not reused after it.
+        """
+        return hashlib.sha1(repr((sorted(set(site_ids)), db_handler.last_update)).encode('utf-8')).hexdigest()[:16]
+
+    def load_selection(selection):
+        """Read the snapshot of the selection in the 'degradation-selection' div.
+
+        Args:
+            selection (str): JSON with the selected system IDs
+
+        Returns:
+            dict with the selected 'ids' (in selection order) and their 'metadata'
+        """
+        site_ids = json.loads(selection)['ids'] if selection else []
+        key = selection_key(site_ids)
+        snapshot = result_cache.get(('selection', key))
+        if snapshot is None:
+            # made by another worker without a shared cache, expired, or made before a metadata refresh
+            snapshot = make_snapshot(site_ids)
+            result_cache[('selection', key)] = snapshot
+        return dict(snapshot, ids=site_ids)
+
+    def make_snapshot(site_ids):
+        return {'ids': site_ids, 'metadata': db_handler.select_metadata(site_ids)}
+
+    def memoize(func):
+        """Cache results of a figure callback by selection snapshot.
+
+        The wrapped callback takes (selection, *args).  Results are keyed on the snapshot key (sorted selected IDs and
+        metadata version) and the remaining arguments, so sorting or filtering the table reuses them.  They are cached
+        in their JSON form (plain dicts and lists, which dash sends unchanged), since dash component classes cannot be
+        pickled for the shared cache.
+        """
+        @functools.wraps(func)
+        def wrapper(selection, *args):
+            key = (func.__name__, selection_key(json.loads(selection)['ids'] if selection else []),
+                   json.dumps(args, sort_keys=True))
+            result = result_cache.get(key)
+            if result is None:
+                result = json.loads(json.dumps(func(selection, *args), cls=plotly.utils.PlotlyJSONEncoder))
+                result_cache[key] = result
+            return result
+        return wrapper
+
+    def table_query(query, sort, page):
+        sort_by, order = sort.split('|')
+        try:
+            page = int(page)
+        except (TypeError, ValueError):
+            page = 1
+        return db_handler.metadata_page(query, sort_by, order == 'asc', page - 1, TABLE_PAGE_SIZE)
+
+    @app.callback(Output('degradation-table_page', 'value'),
+                  [Input('degradation-table_filter', 'value'),
+                   Input('degradation-table_sort', 'value')])
+    def reset_table_page(query, sort):
+        """Go back to the first page when the filter or sort order changes.
+
+        Args:
+            query (str): filter terms
+            sort (str): sort column and order
+
+        Returns:
+            page number
+        """
+        return 1
+
+    @app.callback(Output('degradation-table_page_ids', 'children'),
+                  [Input('degradation-table_filter', 'value'),
+                   Input('degradation-table_sort', 'value'),
+                   Input('degradation-table_page', 'value')])
+    def update_table_page(query, sort, page):
+        """Filter, sort and page the metadata table on the server.
+
+        Args:
+            query (str): filter terms
+            sort (str): sort column and order ('<column>|asc' or '<column>|desc')
+            page (int): page number (from 1)
+
+        Returns:
+            JSON with the IDs of the systems on the requested page and the number of matching systems.
+        """
+        rows, total = table_query(query, sort, page)
+        return json.dumps({'ids': [int(i) for i in rows['ID']], 'total': total})
+
+    @app.callback(Output('degradation-table_info', 'children'),
+                  [Input('degradation-table_page_ids', 'children')])
+    def update_table_info(page_ids):
+        """Show the number of pages and matching systems.
+
+        Args:
+            page_ids (str): current table page
+
+        Returns:
+            page count text
+        """
+        total = json.loads(page_ids)['total']
+        return ' of {} ({} systems)'.format(max(total - 1, 0) // TABLE_PAGE_SIZE + 1, total)
+
+    @app.callback(Output('degradation-map_click', 'children'),
+                  [Input('degradation-map', 'clickData')])
+    def record_map_click(clickData):
+        """Record the system clicked on the map.
+
+        Args:
+            clickData (dict): clicked sites (clusters carry no system ID)
+
+        Returns:
+            JSON with the clicked IDs and the time of the click.
+        """
+        ids = []
+        if clickData:
+            ids = [point['customdata'] for point in clickData['points'] if point.get('customdata') is not None]
+        return json.dumps({'ids': ids, 'ts': time.time()})
+
+    @app.callback(Output('degradation-table_change', 'children'),
+                  [Input('degradation-metadata_table', 'selected_row_indices')],
+                  [State('degradation-table_page_ids', 'children')])
+    def record_table_change(selected_row_indices, page_ids):
+        """Record the selection made on the current table page.
+
+        Args:
+            selected_row_indices (list): selected rows of the page
+            page_ids (str): current table page
+
+        Returns:
+            JSON with the IDs on the page, the selected ones and the time of the change.
+        """
+        page_ids = json.loads(page_ids)['ids']
+        return json.dumps({'page_ids': page_ids, 'selected': [page_ids[i] for i in selected_row_indices
+                                                              if i < len(page_ids)], 'ts': time.time()})
+
+    @app.callback(Output('degradation-selected_ids', 'children'),
+                  [Input('degradation-map_click', 'children'),
+                   Input('degradation-table_change', 'children')],
+                  [State('degradation-selected_ids', 'children')])
+    def merge_selection(map_click, table_change, selected_ids):
+        """Apply the latest map click or table change to the selected IDs.
+
+        Dash cannot tell which input fired, so each event carries a timestamp and only the newest one, if it is newer
+        than the last applied event, is applied.  Table changes are applied as the difference with the previous
+        state of the same page, so systems toggled on the map are kept.  Events that change nothing (such as the
+        table re-rendered by update_table) are not propagated.
+
+        Args:
+            map_click (str): last map click
+            table_change (str): last table page selection
+            selected_ids (str): current selection
+
+        Returns:
+            JSON with the selected IDs (in selection order), the time of the last applied event and the last table
+            page state.
+        """
+        selection = json.loads(selected_ids) if selected_ids else {'ids': [], 'ts': 0}
+        events = [json.loads(i) for i in [map_click, table_change] if i]
+        if not events:
+            raise PreventUpdate
+        event = max(events, key=lambda e: e['ts'])
+        if event['ts'] <= selection['ts']:
+            raise PreventUpdate
+
+        ids = list(selection['ids'])
+        page_ids, page_selected = selection.get('page_ids'), selection.get('page_selected')
+        if 'page_ids' in event:
+            if event['page_ids'] != page_ids:
+                # new page, checked as in update_table
+                page_selected = [i for i in event['page_ids'] if i in set(ids)]
+            removed = set(page_selected) - set(event['selected'])
+            ids = [i for i in ids if i not in removed]
+            ids += [i for i in event['selected'] if i not in ids]
+            page_ids, page_selected = event['page_ids'], event['selected']
+        else:
+            # clicking a selected system de-selects it
+            for i in event['ids']:
+                if i in ids:
+                    ids.remove(i)
+                else:
+                    ids.append(i)
+            if page_ids is not None:
+                # update_table re-checks the page from the new selection
+                page_selected = [i for i in page_ids if i in set(ids)]
+        if (ids == selection['ids'] and page_ids == selection.get('page_ids') and
+                page_selected == selection.get('page_selected')):
+            raise PreventUpdate
+        return json.dumps({'ids': ids, 'ts': event['ts'], 'page_ids': page_ids, 'page_selected': page_selected})
+
+    @app.callback(Output('degradation-table_container', 'children'),
+                  [Input('degradation-table_page_ids', 'children'),
+                   Input('degradation-selected_ids', 'children')],
+                  [State('degradation-table_rendered', 'children'),
+                   State('degradation-metadata_table', 'selected_row_indices')])
+    def update_table(page_ids, selected_ids, rendered, selected_row_indices):
+        """Show the current table page with the selected systems checked.
+
+        The table is re-rendered (rather than its checked rows updated) so that selection changes made on the map
+        reach the checkboxes without a callback cycle; it is left alone when it already shows the requested state.
+
+        Args:
+            page_ids (str): current table page
+            selected_ids (str): current selection
+            rendered (str): IDs of the rows shown in the table
+            selected_row_indices (list): rows checked in the table
+
+        Returns:
+            metadata table
+        """
+        page_ids = json.loads(page_ids)['ids']
+        ids = set(json.loads(selected_ids)['ids']) if selected_ids else set()
+        checked = [i for i, system_id in enumerate(page_ids) if system_id in ids]
+        if rendered and json.loads(rendered) == page_ids and sorted(selected_row_indices or []) == checked:
+            raise PreventUpdate
+        return make_table(db_handler.select_metadata(page_ids)[TABLE_COLUMNS].to_dict('records'), checked)
+
+    @app.callback(Output('degradation-selection', 'children'),
+                  [Input('degradation-selected_ids', 'children')])
+    def resolve_selection(selected_ids):
+        """Resolve the selection once per interaction for all figure callbacks.
+
+        Args:
+            selected_ids (str): selected system IDs
+
+        Returns:
+            JSON with the key of the server-side selection snapshot and the selected system IDs.
+        """
+        site_ids = [int(i) for i in json.loads(selected_ids)['ids']] if selected_ids else []
+        key = selection_key(site_ids)
+        if result_cache.get(('selection', key)) is None:
+            result_cache[('selection', key)] = make_snapshot(site_ids)
+        return json.dumps({'key': key, 'ids': site_ids})
+
 
     @app.callback(
         Output('degradation-selected', 'style'),
-        [Input('degradation-metadata_table', 'selected_row_indices')]
+        [Input('degradation-selection', 'children')]
     )
-    def make_deg_mode_dropdown(points):
+    def make_deg_mode_dropdown(selection):
         """Create dropdown menu of degradation rate calculation methods.
 
         Args:
-            points (list): system_id values (if not empty, menu will show).
+            selection (str): selection snapshot (if not empty, menu will show).
 
         Returns:
             Makes dropdown menu visible.
         """
-        site_ids = [metadata.iloc[i]['ID'] for i in points]
+        site_ids = json.loads(selection)['ids'] if selection else []
 
         if site_ids:
             style = {'visibility': 'visible'}
@@ -50,21 +310,21 @@ def add_callbacks(app, db_handler):
 
     @app.callback(
         Output('degradation-deg_modes_master', 'style'),
-        [Input('degradation-metadata_table', 'selected_row_indices'),
+        [Input('degradation-selection', 'children'),
          Input('degradation-selected', 'children')]
     )
-    def make_deg_mode_dropdown(points, dummy_fig):
+    def make_deg_mode_dropdown(selection, dummy_fig):
         """Create dropdown menu of degradation rate calculation methods.
 
         Args:
-            points (list): system_id values
+            selection (str): selection snapshot
             dummy_fig (children): figure that has no effect on functionality - included here to force a dependency
                                   that makes loading 'prettier'
 
         Returns:
             Makes dropdown menu visible.
         """
-        site_ids = [metadata.iloc[i]['ID'] for i in points]
+        site_ids = json.loads(selection)['ids'] if selection else []
 
         if site_ids:
             style = {'visibility': 'visible'}
@@ -73,27 +333,63 @@ def add_callbacks(app, db_handler):
 
         return style
 
-    @app.callback(
-        Output('degradation-metadata_table', 'selected_row_indices'),
-        [Input('degradation-map', 'clickData')],
-        [State('datatable-gapminder', 'selected_row_indices')])
-    def update_selected_row_indices(clickData, selected_row_indices):
-        """Add clicked sites to charts.
+    @app.callback(Output('degradation-map', 'figure'),
+                  [Input('degradation-map', 'relayoutData')])
+    def update_map(relayoutData):
+        """Re-cluster the map for the current zoom level and view.
 
         Args:
-            clickData (list): clicked sites
-            selected_row_indices (list): selected sites
+            relayoutData (dict): map view after zooming or panning
 
         Returns:
-            selected row indices
+            map figure
         """
-        if clickData:
-            for point in clickData['points']:
-                if point['pointNumber'] in selected_row_indices:
-                    selected_row_indices.remove(point['pointNumber'])
-                else:
-                    selected_row_indices.append(point['pointNumber'])
-        return selected_row_indices
+        relayoutData = relayoutData or {}
+        return make_map_figure(db_handler, zoom=relayoutData.get('mapbox.zoom', MAP_ZOOM),
+                               center=relayoutData.get('mapbox.center'))
+
+    @app.callback(Output('degradation-prefetch_map', 'children'),
+                  [Input('degradation-map', 'hoverData'),
+                   Input('degradation-map', 'clickData')],
+                  [State('degradation-data_smoother', 'value')])
+    def prefetch_map_points(hoverData, clickData, smoother):
+        """Start loading data of hovered or clicked sites before they are selected.
+
+        Args:
+            hoverData (dict): hovered sites
+            clickData (dict): clicked sites
+            smoother (str): smoothing method of the performance plot
+
+        Returns:
+            Empty string (the output is a hidden div).
+        """
+        site_ids = []
+        for data in [clickData, hoverData]:
+            if data:
+                site_ids.extend(point['customdata'] for point in data['points'] if point.get('customdata') is not None)
+        if site_ids:
+            db_handler.prefetch(site_ids, group='map', resolution='weekly', smoother=smoother or 'raw')
+        return ''
+
+    @app.callback(Output('degradation-prefetch_table', 'children'),
+                  [Input('degradation-table_page_ids', 'children')],
+                  [State('degradation-table_filter', 'value'),
+                   State('degradation-data_smoother', 'value')])
+    def prefetch_table_rows(page_ids, query, smoother):
+        """Start loading data of the sites on a filtered table page.
+
+        Args:
+            page_ids (str): current table page
+            query (str): filter terms
+            smoother (str): smoothing method of the performance plot
+
+        Returns:
+            Empty string (the output is a hidden div).
+        """
+        site_ids = json.loads(page_ids)['ids']
+        if site_ids and query:
+            db_handler.prefetch(site_ids, group='table', resolution='weekly', smoother=smoother or 'raw')
+        return ''
 
     # @app.callback(Output('degradation-selected', 'children'),
     #               [Input('degradation-metadata_table', 'rows'),
@@ -137,61 +433,102 @@ def add_callbacks(app, db_handler):
     #
     #     return div
 
+    @app.callback(Output('degradation-heatmap_zoom', 'children'),
+                  [Input('degradation-selected_graph', 'relayoutData')],
+                  [State('degradation-selection', 'children')])
+    def record_heatmap_zoom(relayoutData, selection):
+        """Record a heatmap zoom together with the selection it was made on.
+
+        The graph keeps its last relayoutData when the selection changes; tagging it lets make_individual_figure
+        open a new selection unzoomed.
+
+        Args:
+            relayoutData (dict): zoom state of the heatmap
+            selection (str): selection snapshot
+
+        Returns:
+            JSON with the selection key and the relayoutData.
+        """
+        return json.dumps({'key': json.loads(selection)['key'] if selection else None, 'relayout': relayoutData})
+
     @app.callback(Output('degradation-selected_graph', 'figure'),
-                  [Input('degradation-metadata_table', 'rows'),
-                   Input('degradation-metadata_table', 'selected_row_indices'),
-                   Input('degradation-data_smoother', 'value')])
-    def make_individual_figure(rows, selected_row_indices, smoother):
+                  [Input('degradation-selection', 'children'),
+                   Input('degradation-data_smoother', 'value'),
+                   Input('degradation-heatmap_zoom', 'children')])
+    @memoize
+    def make_individual_figure(selection, smoother, zoom):
         """Plot all clicked points.
 
+        The heatmap is aggregated to at most HEATMAP_MAX_COLUMNS dates and HEATMAP_MAX_ROWS system groups.  Zooming
+        re-renders the visible date range at a finer resolution and re-bins only the visible systems, down to one row
+        per system.  Systems are sorted by ID and drawn on a numeric y-axis (row i at y = i), so a zoomed y range
+        always maps to the same systems.
+
         Args:
-            rows (pd.DataFrame): metadata table
-            selected_row_indices (list): selected sites
+            selection (str): selection snapshot
             smoother (str): which smoothing method for plot
+            zoom (str): zoom state of the heatmap (see record_heatmap_zoom)
 
         Returns:
             html.Div object that is empty (if no points clicked) or displays a plot of all sites.
         """
-        site_ids = [rows[i]['ID'] for i in selected_row_indices]
+        site_ids = load_selection(selection)['ids']
 
         if not site_ids:
             return html.Div(style={'display': 'none'})
 
-        dfdict = db_handler.get_system_data(site_ids, allow_add=True)
+        # a zoom made on another selection does not apply
+        zoom = json.loads(zoom) if zoom else {}
+        relayoutData = zoom.get('relayout') if zoom.get('key') == json.loads(selection).get('key') else None
+
+        # smoothing and weekly/monthly aggregation are precomputed in the stored rollups; zoomed ranges are not
+        # cached (the full-range entries are sliced instead)
+        start, end = zoom_range(relayoutData)
+        resolution = lod_resolution(start, end, smoother, HEATMAP_MAX_COLUMNS)
+        site_ids = sorted(site_ids)
+        first, stop = zoom_rows(relayoutData, len(site_ids))
+        visible = site_ids[first: stop]
+        dfdict = db_handler.get_system_data(visible, allow_add=start is None, start=start, end=end,
+                                            resolution=resolution, smoother=smoother)
 
         vals = {}
         for system_id, df in dfdict.items():
-            try:
-                if smoother == 'rolling':
-                    df = deg.rolling_mean(df)
-                    # col = 'Power(W) norm trend rolling mean'
-                elif smoother == 'csd':
-                    df = deg.csd(df)
-                    # col = 'Power(W) norm trend csd'
-                else:
-                    pass
-                tmp = df.resample('W').median()
-                tmp.index = tmp.index.map(lambda x: x.date())
-                vals[system_id] = tmp
-            except:
-                print(system_id)
-
-        df2 = pd.DataFrame.from_dict(vals, orient='index')
+            if len(df) == 0:
+                continue
+            vals[system_id] = pd.Series(df.values, index=df.index.date)
+        # systems without rollups are smoothed by the handler (with a timeout); report the ones that failed
+        failed = [i for i in visible if i not in dfdict and (i, resolution, smoother) in db_handler.errors]
+
+        # one row per visible system (empty rows keep the positions of systems without data)
+        df2 = pd.DataFrame.from_dict(vals, orient='index').reindex(visible)
         df2 = df2.T
         df2 = df2.sort_index()
-
-        hovertext = []
-        for yi, yy in enumerate(df2.keys()):
-            hovertext.append([])
-            for xi, xx in enumerate(df2.index):
-                text = 'System ID: {}<br />Date: {}<br />Performance: {:.3f}'.format(yy, xx, df2.values[xi, yi])
-                hovertext[-1].append(text)
-
-        plots = [go.Heatmap(x=df2.index, y=['[{}]'.format(i) for i in df2.keys()], z=df2.values.T,
+        df2, _ = bin_rows(df2, HEATMAP_MAX_COLUMNS)
+        df_sys, step = bin_rows(df2.T, HEATMAP_MAX_ROWS)
+        df2 = df_sys.T
+
+        # rows average groups of consecutive systems, drawn at the center of their positions
+        starts = list(range(0, len(visible), step))
+        ends = [min(i + step, len(visible)) - 1 for i in starts]
+        yvals = [first + (i + j) / 2. for i, j in zip(starts, ends)]
+        ylabels = ['[{}]'.format(visible[i]) if i == j else '[{}-{}]'.format(visible[i], visible[j])
+                   for i, j in zip(starts, ends)]
+        every = int(np.ceil(len(yvals) / float(HEATMAP_MAX_LABELS)))
+
+        # the numeric y values are positions, so the system (group) of each cell is shown in the hover as text;
+        # rounding z to the displayed precision keeps the payload small
+        plots = [go.Heatmap(x=df2.index, y=yvals, z=np.round(df2.values.T, 3),
+                            text=[['System ID: {}'.format(label)] * len(df2.index) for label in ylabels],
                             colorbar={'title': 'Normalized Performance', 'titleside': 'right'},
-                            hoverinfo='text', text=hovertext, colorscale='Reds')]
-        layout = go.Layout(xaxis={'title': 'Date', 'showgrid': False}, yaxis={'title': 'System ID', 'showgrid': False},
-                           title='Performance of {} selected sites'.format(len(vals)))
+                            hoverinfo='x+text+z', colorscale='Reds')]
+        layout = go.Layout(xaxis={'title': 'Date', 'showgrid': False},
+                           yaxis={'title': 'System ID', 'showgrid': False, 'tickvals': yvals[::every],
+                                  'ticktext': ylabels[::every], 'range': [first - .5, stop - .5]},
+                           title='Performance of {} selected sites'.format(len(site_ids)))
+        if failed:
+            message = 'Could not smooth system(s) {}'.format(', '.join(str(i) for i in failed))
+            layout['annotations'] = [{'text': message, 'xref': 'paper', 'yref': 'paper', 'x': 0, 'y': 1.05,
+                                      'xanchor': 'left', 'showarrow': False}]
 
         if plots:
             figure = {'data': plots,
@@ -202,26 +539,24 @@ def add_callbacks(app, db_handler):
         return figure
 
     @app.callback(Output('degradation-deg_modes_histogram', 'figure'),
-                  [Input('degradation-metadata_table', 'rows'),
-                   Input('degradation-metadata_table', 'selected_row_indices')])
-    def make_deg_modes_hist(rows, selected_row_indices):
+                  [Input('degradation-selection', 'children')])
+    @memoize
+    def make_deg_modes_hist(selection):
         """Make plot showing distribution of degradation rates and methods.
 
         Args:
-            rows (dict): metadata table
-            selected_row_indices (list): selected sites
+            selection (str): selection snapshot
 
         Returns
             plot that shows distribution of degradation rates
         """
-        site_ids = [rows[i]['ID'] for i in selected_row_indices]
-
-        tmp_meta = metadata.where(metadata['ID'].isin(site_ids)).dropna(how='any')
+        site_ids = load_selection(selection)['ids']
+        rates = db_handler.rate_distributions()
 
         traces = []
         names = []
         for val, name in zip(['ols_rd', 'csd_rd', 'yoy_rd'], ['OLS', 'CSD', 'YOY']):
-            traces.append(go.Histogram(x=tmp_meta[val], name=name))
+            traces.append(go.Histogram(x=rates.values(val, site_ids), name=name))
             # traces.append(tmp_meta[val].values)
             # names.append(name)
 
@@ -233,21 +568,19 @@ def add_callbacks(app, db_handler):
         return {'data': traces, 'layout': layout}
 
     @app.callback(Output('degradation-deg_modes_cumhistogram', 'figure'),
-                  [Input('degradation-metadata_table', 'rows'),
-                   Input('degradation-metadata_table', 'selected_row_indices')])
-    def make_deg_modes_cumhist(rows, selected_row_indices):
+                  [Input('degradation-selection', 'children')])
+    @memoize
+    def make_deg_modes_cumhist(selection):
         """Make plot of cumulative distribution of degradation rates/modes.
 
         Args:
-            rows (dict): metadata table
-            selected_row_indices (list): selected sites
+            selection (str): selection snapshot
 
         Returns:
             plot of cumulative distributions
         """
-        site_ids = [rows[i]['ID'] for i in selected_row_indices]
-
-        tmp_meta = metadata.where(metadata['ID'].isin(site_ids)).dropna(how='any').copy()
+        site_ids = load_selection(selection)['ids']
+        rates = db_handler.rate_distributions()
 
         traces = []
         for val, name in zip(['ols_rd', 'csd_rd', 'yoy_rd'], ['OLS', 'CSD', 'YOY']):
@@ -255,30 +588,28 @@ def add_callbacks(app, db_handler):
             # traces.append(go.Scatter(x=xvals, y=norm.cdf(xvals), name=name))
             # traces.append(go.Histogram(x=tmp_meta[val], name=name, cumulative={'enabled': True}, opacity=0))
             # break
-            hist, bin_edges = np.histogram(tmp_meta[val], normed=True, bins=500)
-            traces.append(go.Scatter(x=bin_edges, y=np.cumsum(hist) * (bin_edges[1] - bin_edges[0]), name=name))
+            # exact ECDF from the presorted fleet rates
+            xvals, yvals = rates.ecdf(val, site_ids)
+            traces.append(go.Scatter(x=xvals, y=yvals, name=name, line={'shape': 'hv'}))
 
         layout = go.Layout(title='Population degradation rates',
-                           xaxis={'title': 'Degradation rate (%/year)'}, yaxis={'title': 'System count'})
+                           xaxis={'title': 'Degradation rate (%/year)'}, yaxis={'title': 'Fraction of systems'})
 
         return {'data': traces, 'layout': layout}
 
     @app.callback(Output('degradation-deg_modes_by_site', 'figure'),
-                  [Input('degradation-metadata_table', 'rows'),
-                   Input('degradation-metadata_table', 'selected_row_indices')])
-    def make_deg_modes_by_site(rows, selected_row_indices):
+                  [Input('degradation-selection', 'children')])
+    @memoize
+    def make_deg_modes_by_site(selection):
         """Make plot of degradation modes by site.
 
         Args:
-            rows (dict): metadata table
-            selected_row_indices (list): selected sites
+            selection (str): selection snapshot
 
         Returns:
             plot of degradatiom odes by site
         """
-        site_ids = [rows[i]['ID'] for i in selected_row_indices]
-
-        tmp_meta = metadata.where(metadata['ID'].isin(site_ids)).dropna(how='any').copy()
+        tmp_meta = load_selection(selection)['metadata']
 
         traces = []
         for val, name in zip(['ols_rd', 'csd_rd', 'yoy_rd'], ['OLS', 'CSD', 'YOY']):
@@ -290,37 +621,43 @@ def add_callbacks(app, db_handler):
         return {'data': traces, 'layout': layout}
 
     @app.callback(Output('degradation-meta_figure', 'children'),
-                  [Input('degradation-metadata_table', 'rows'),
-                   Input('degradation-metadata_table', 'selected_row_indices')])
-    def make_deg_meta_figure(rows, selected_row_indices):
+                  [Input('degradation-selection', 'children')])
+    @memoize
+    def make_deg_meta_figure(selection):
         """Plot all clicked points.
 
         Args:
-            rows (dict): metadata table
-            selected_row_indices (list): selected sites
+            selection (str): selection snapshot
 
         Returns:
             plots of degradation rates and modes broken down by metadata tags (climate, location, system size, age)
         """
-        site_ids = [rows[i]['ID'] for i in selected_row_indices]
-
-        tmp_meta = metadata.where(metadata['ID'].isin(site_ids)).dropna(how='any').copy()
+        tmp_meta = load_selection(selection)['metadata']
+        methods = [('ols_rd', 'OLS'), ('csd_rd', 'CSD'), ('yoy_rd', 'YOY')]
 
+        # boxes are drawn from per-group statistics, so the figures grow with the number of groups (and outliers)
+        # rather than the number of selected systems
         traces = {}
-        for meta in ['State', 'Climate']:
-            traces[meta] = []
-            traces[meta].append(go.Box(x=tmp_meta[meta], y=tmp_meta['ols_rd'], name='OLS'))
-            traces[meta].append(go.Box(x=tmp_meta[meta], y=tmp_meta['csd_rd'], name='CSD'))
-            traces[meta].append(go.Box(x=tmp_meta[meta], y=tmp_meta['yoy_rd'], name='YOY'))
-
-        for meta in ['Size (W)', 'Active Days']:
-            tmp_meta['interval'] = pd.cut(tmp_meta[meta], 10)
-            tmp_meta = tmp_meta.sort_values('interval')
-            tmp_meta['interval'] = tmp_meta['interval'].astype(str)
+        for meta in ['State', 'Climate', 'Size (W)', 'Active Days']:
+            if meta in ['State', 'Climate']:
+                keys = tmp_meta[meta]
+                order = sorted(keys.dropna().unique())
+            elif tmp_meta[meta].notnull().any():
+                bins = pd.cut(tmp_meta[meta], 10)
+                keys = bins.astype(str).where(bins.notnull())
+                order = [str(i) for i in bins.cat.categories]
+            else:
+                keys, order = pd.Series(np.nan, index=tmp_meta.index), []
+            stats = box_stats(tmp_meta, keys, [col for col, _ in methods])
             traces[meta] = []
-            traces[meta].append(go.Box(x=tmp_meta['interval'], y=tmp_meta['ols_rd'], name='OLS'))
-            traces[meta].append(go.Box(x=tmp_meta['interval'], y=tmp_meta['csd_rd'], name='CSD'))
-            traces[meta].append(go.Box(x=tmp_meta['interval'], y=tmp_meta['yoy_rd'], name='YOY'))
+            for col, name in methods:
+                x, y = [], []
+                for group, row in stats[col].reindex(order).dropna(subset=['q1']).iterrows():
+                    sample = box_sample(row['q1'], row['median'], row['q3'], row['lowerfence'],
+                                        row['upperfence'], row['outliers'])
+                    x.extend([group] * len(sample))
+                    y.extend(sample)
+                traces[meta].append(go.Box(x=x, y=y, name=name, boxpoints='outliers'))
 
         layout = go.Layout(boxmode='group')
         layouts = {}
@@ -1,5 +1,6 @@
 
 import os
+import json
 
 
 import dash_core_components as dcc
@@ -12,7 +13,71 @@ import numpy as np
 
 from . import utils
 
-from app import client
+
+MAP_CENTER = {'lat': 38, 'lon': -96}
+MAP_ZOOM = 2.5
+
+# metadata table columns and rows per page (the table is filtered, sorted and paged server-side)
+TABLE_COLUMNS = ['ID', 'Size (W)', 'State', 'County', 'Climate', 'Active Days']
+TABLE_PAGE_SIZE = 20
+
+
+def make_table(rows, selected_row_indices=()):
+    """Make the metadata table of one page.
+
+    Args:
+        rows (list): table rows (dicts of TABLE_COLUMNS).
+        selected_row_indices (list): checked rows.
+
+    Returns:
+        DataTable component and a hidden div with the IDs of its rows (so callbacks never read the rows back).
+    """
+    return [
+        dt.DataTable(
+            rows=rows,
+            columns=TABLE_COLUMNS,
+            row_selectable=True,
+            sortable=False,
+            filterable=False,
+            selected_row_indices=list(selected_row_indices),
+            editable=False,
+            id='degradation-metadata_table',
+        ),
+        html.Div(id='degradation-table_rendered', style={'display': 'none'},
+                 children=json.dumps([int(row['ID']) for row in rows])),
+    ]
+
+
+def make_map_figure(db_handler, zoom=MAP_ZOOM, center=None):
+    """Make the systems map at a zoom level.
+
+    Nearby systems are drawn as a single cluster marker sized by the number of systems; single systems are drawn as
+    points carrying their ID (used to select them by clicking).  Clusters outside the viewport are left out.
+
+    Args:
+        db_handler (DBHandler object): object to perform database queries.
+        zoom (float): mapbox zoom level.
+        center (dict): map center, {'lat': .., 'lon': ..} (default view if None).
+
+    Returns:
+        map figure.
+    """
+    clusters = utils.visible_points(db_handler.map_clusters(zoom), zoom, center)
+    single = clusters[clusters['count'] == 1]
+    groups = clusters[clusters['count'] > 1]
+
+    data = [go.Scattermapbox(lon=single['longitude (deg)'].values, lat=single['latitude (deg)'].values,
+                             customdata=single['ID'].values, text=single['text'].values,
+                             marker={'color': np.log(single['Size (W)'].values)}),
+            go.Scattermapbox(lon=groups['longitude (deg)'].values, lat=groups['latitude (deg)'].values,
+                             text=['{} systems (zoom in to select)'.format(i) for i in groups['count']],
+                             hoverinfo='text',
+                             marker={'size': np.minimum(8 + 3 * np.sqrt(groups['count'].values), 40),
+                                     'color': 'rgb(31, 119, 180)', 'opacity': .6})]
+    layout = go.Layout(mapbox={'accesstoken': os.environ['MAPBOX_KEY'], 'bearing': 0, 'center': center or MAP_CENTER,
+                               'pitch': 0, 'zoom': zoom, 'style': 'light'}, hovermode='closest', autosize=True,
+                       height=480, showlegend=False, margin={'r': 0, 't': 0, 'b': 0, 'l': 0, 'pad': 0})
+    return {'data': data, 'layout': layout}
 
 
 def serve_layout(db_handler):
@@ -24,11 +89,7 @@ def serve_layout(db_handler):
     Returns:
         degradation app page.
     """
-    mapbox_access_token = os.environ['MAPBOX_KEY']
-    metadata = db_handler.get_system_metadata()
-    map_layout = go.Layout(mapbox={'accesstoken': mapbox_access_token, 'bearing': 0, 'center': {'lat':38, 'lon': -96},
-                       'pitch': 0, 'zoom': 2.5, 'style': 'light'}, hovermode='closest', autosize=True, height=480,
-                       showlegend=False, margin={'r': 0, 't': 0, 'b': 0, 'l': 0, 'pad': 0})
+    first_page, n_systems = db_handler.metadata_page(page_size=TABLE_PAGE_SIZE)
 
     # degradation page layout
     app_layout =  \
@@ -43,24 +104,33 @@ def serve_layout(db_handler):
             html.Div([html.H3('Systems overview', style={'textAlign': 'center'}),
             html.Div([
                 html.Div([
-                        dcc.Graph(id='degradation-map', animate=True,
-                                  figure={'data': [go.Scattermapbox(lon=metadata['longitude (deg)'].values,
-                                                                    lat=metadata['latitude (deg)'].values,
-                                                                    customdata=metadata['ID'], text=metadata['text'],
-                                                                    marker={'color': np.log(metadata['Size (W)'])}),],
-                                          'layout': map_layout})
+                        # re-clustered on zoom (see callbacks.update_map)
+                        dcc.Graph(id='degradation-map', figure=make_map_figure(db_handler))
                 ], className='six columns'),
                 html.Div([
-                    dt.DataTable(
-                        rows=metadata[['ID', 'Size (W)', 'State', 'County', 'Climate', 'Active Days']].to_dict('records'),
-                        columns=['ID', 'Size (W)', 'State', 'County', 'Climate', 'Active Days'],
-                        row_selectable=True,
-                        sortable=True,
-                        filterable=True,
-                        selected_row_indices=[],
-                        editable=False,
-                        id='degradation-metadata_table',
-                    ),
+                    html.Div([
+                        dcc.Input(id='degradation-table_filter', type='text', value='',
+                                  placeholder='Filter by ID, name, state, county or climate',
+                                  style={'width': '100%'}),
+                    ], className='row'),
+                    html.Div([
+                        html.Div([
+                            dcc.Dropdown(id='degradation-table_sort', value='ID|asc', clearable=False,
+                                         options=[{'label': 'Sort by {} ({})'.format(col, label),
+                                                   'value': '{}|{}'.format(col, order)}
+                                                  for col in TABLE_COLUMNS
+                                                  for order, label in [('asc', 'ascending'), ('desc', 'descending')]]),
+                        ], className='eight columns'),
+                        html.Div([
+                            dcc.Input(id='degradation-table_page', type='number', value=1, min=1,
+                                      style={'width': '70px'}),
+                            html.Span(id='degradation-table_info',
+                                      children=' of {}'.format(max(n_systems - 1, 0) // TABLE_PAGE_SIZE + 1)),
+                        ], className='four columns'),
+                    ], className='row'),
+                    # re-rendered on page changes and map clicks (see callbacks.update_table)
+                    html.Div(id='degradation-table_container',
+                             children=make_table(first_page[TABLE_COLUMNS].to_dict('records'))),
                 ], className='six columns', style={'margin': {'r': 0, 't': 0, 'b': 0, 'l': 0}}),
                 # ], className='six columns', style={'margin': {'r': 20, 't': 40, 'b': 20, 'l': 20, 'pad': 0}, 'height': '500px'}),
             ], className='row'),
@@ -131,6 +201,20 @@ def serve_layout(db_handler):
         # ], style={'visibility': 'hidden', 'textAlign': 'center'}),
         # html.Div(id='degradation-deg_plots'),
         html.Div(id='degradation-hidden', style={'display': 'none'}),
+        # IDs of the systems on the current table page; callbacks take these instead of the table rows
+        html.Div(id='degradation-table_page_ids', style={'display': 'none'},
+                 children=json.dumps({'ids': [int(i) for i in first_page['ID']], 'total': n_systems})),
+        # selection state: last map click, last table (page) selection, and the merged selected IDs
+        html.Div(id='degradation-map_click', style={'display': 'none'}),
+        html.Div(id='degradation-table_change', style={'display': 'none'}),
+        html.Div(id='degradation-selected_ids', children=json.dumps({'ids': [], 'ts': 0}), style={'display': 'none'}),
+        # key of the server-side snapshot of the current selection (see callbacks.resolve_selection)
+        html.Div(id='degradation-selection', style={'display': 'none'}),
+        # heatmap zoom and the selection it was made on (see callbacks.record_heatmap_zoom)
+        html.Div(id='degradation-heatmap_zoom', style={'display': 'none'}),
+        # outputs of the callbacks prefetching data for systems about to be selected
+        html.Div(id='degradation-prefetch_map', style={'display': 'none'}),
+        html.Div(id='degradation-prefetch_table', style={'display': 'none'}),
     ])
 
     return app_layout
@@ -147,6 +147,28 @@ def rolling_mean(df, column='Power(W) norm'):
     return df.rolling('90D').mean()
 
 
+def smooth(df, smoother='raw'):
+    """Apply one of the dashboard smoothers.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+    smoother: str
+        'raw' (no smoothing), 'rolling' (90 day rolling mean) or 'csd' (classical seasonal decomposition).
+
+    Returns
+    -------
+    df: pd.DataFrame
+    """
+    if smoother == 'raw':
+        return df
+    elif smoother == 'rolling':
+        return rolling_mean(df)
+    elif smoother == 'csd':
+        return csd(df)
+    raise ValueError('Unknown smoother {}'.format(smoother))
+
+
 def lowess(df, column='Power(W) norm'):
     """Perform LOWESS smoothing.
 
@@ -0,0 +1,420 @@
+"""
+Binary encoding of the per-system `performance` field.
+
+The ingestion notebook originally stored `pickle.dumps(daily)` for every system.  Pickled DataFrames are slow to
+load and tied to the pandas version that wrote them, so performance data is now stored as a versioned columnar
+document: raw little-endian float arrays plus enough information (start, frequency, time zone) to rebuild the
+regular time index.  Legacy pickled blobs are still readable and can be rewritten with `migrate_performance`.
+
+Version 2 splits the values into one binary block per calendar year so that date-range queries can `$slice` the
+blocks server-side and only transfer the years that were asked for.  The price is one copy on decode: the blocks
+of a series spanning more than one calendar year (i.e. every real system) are joined into a new buffer, so only
+single-block reads keep the zero-copy decode of version 1.
+
+Weekly and monthly rollups of the daily data, for each dashboard smoother, are stored under
+`rollups.<resolution>.<smoother>` using the same encoding.
+"""
+
+import pickle
+import datetime
+import collections
+
+import pandas as pd
+import numpy as np
+from pymongo import UpdateOne
+
+from . import degradation_functions as deg
+
+
+FORMAT_VERSION = 2
+
+# resolution name -> pandas frequency
+RESOLUTIONS = collections.OrderedDict([('daily', 'D'), ('weekly', 'W'), ('monthly', 'M')])
+
+# smoothers with stored rollups (see degradation_functions.smooth)
+SMOOTHERS = ('raw', 'rolling', 'csd')
+
+
+def rollup_field(resolution, smoother='raw'):
+    """Name of the document field holding data at a given resolution.
+
+    Parameters
+    ----------
+    resolution: str
+        One of RESOLUTIONS.
+    smoother: str
+        One of SMOOTHERS.
+
+    Returns
+    -------
+    field: str or None
+        Dotted MongoDB field path (None for smoothed daily data, which is not stored).
+    """
+    if resolution not in RESOLUTIONS:
+        raise ValueError('Unknown resolution {}, expected one of {}'.format(resolution, list(RESOLUTIONS)))
+    if smoother not in SMOOTHERS:
+        raise ValueError('Unknown smoother {}, expected one of {}'.format(smoother, list(SMOOTHERS)))
+    if resolution == 'daily':
+        return 'performance' if smoother == 'raw' else None
+    return 'rollups.{}.{}'.format(resolution, smoother)
+
+
+def resample_performance(series, resolution):
+    """Aggregate daily performance data to a coarser resolution (median per period).
+
+    Parameters
+    ----------
+    series: pd.Series
+        Daily performance data.
+    resolution: str
+        One of RESOLUTIONS.
+
+    Returns
+    -------
+    series: pd.Series
+    """
+    if resolution == 'daily' or not isinstance(series, (pd.Series, pd.DataFrame)):
+        return series
+    return series.resample(RESOLUTIONS[resolution]).median()
+
+
+def make_rollup(series, resolution, smoother='raw'):
+    """Smooth daily performance data and aggregate it to a resolution.
+
+    Parameters
+    ----------
+    series: pd.Series
+        Daily performance data (full history, smoothers are sensitive to edge effects).
+    resolution: str
+        One of RESOLUTIONS.
+    smoother: str
+        One of SMOOTHERS.
+
+    Returns
+    -------
+    series: pd.Series
+    """
+    return resample_performance(deg.smooth(series, smoother), resolution)
+
+
+def slice_performance(series, start=None, end=None):
+    """Restrict a time series to [start, end] without copying its values.
+
+    Parameters
+    ----------
+    series: pd.Series
+    start, end: pd.Timestamp or None
+        Inclusive bounds; naive bounds are interpreted in the time zone of the series.
+
+    Returns
+    -------
+    series: pd.Series
+    """
+    if not isinstance(series, (pd.Series, pd.DataFrame)) or (start is None and end is None):
+        return series
+    lo, hi = index_bounds(series.index, start, end)
+    return series.iloc[lo: hi]
+
+
+def index_bounds(index, start=None, end=None):
+    """Positions delimiting [start, end] in a sorted time index.
+
+    Parameters
+    ----------
+    index: pd.DatetimeIndex
+    start, end: pd.Timestamp or None
+        Inclusive bounds; naive bounds are interpreted in the time zone of the index.
+
+    Returns
+    -------
+    lo, hi: int
+        index[lo: hi] lies within the bounds.
+    """
+    lo, hi = 0, len(index)
+    if start is not None:
+        lo = index.searchsorted(_localize(start, index.tz))
+    if end is not None:
+        hi = index.searchsorted(_localize(end, index.tz), side='right')
+    return int(lo), int(hi)
+
+
+def _localize(ts, tz):
+    ts = pd.Timestamp(ts)
+    if tz is not None and ts.tzinfo is None:
+        return ts.tz_localize(tz)
+    if tz is None and ts.tzinfo is not None:
+        return ts.tz_convert(None)
+    return ts
+
+
+def encode_performance(series, dtype='float64'):
+    """Encode a regularly sampled time series as a columnar document.
+
+    Parameters
+    ----------
+    series: pd.Series or None
+        Time series with a regular DatetimeIndex (e.g. rdtools daily aggregation).  None or empty series are
+        encoded as an empty document (analysis failed for the system).
+    dtype: str
+        Storage dtype of the values ('float64' or 'float32').
+
+    Returns
+    -------
+    doc: dict
+        Document suitable for insertion in MongoDB.
+    """
+    dtype = np.dtype(dtype).newbyteorder('<')
+    doc = {'version': FORMAT_VERSION, 'dtype': dtype.str, 'freq': None, 'tz': None, 'name': None,
+           'start_year': None, 'block_starts': [], 'blocks': []}
+    if series is None or len(series) == 0:
+        return doc
+
+    if isinstance(series, pd.DataFrame):
+        if series.shape[1] != 1:
+            raise ValueError('Only single column performance data can be encoded.')
+        series = series.iloc[:, 0]
+
+    header = index_header(series)
+    doc['freq'], doc['tz'], doc['name'] = header['freq'], header['tz'], header['name']
+
+    values = np.ascontiguousarray(series.values, dtype=dtype)
+    years = series.index.year
+    bounds = np.concatenate([[0], np.flatnonzero(np.diff(years)) + 1, [len(values)]])
+
+    doc['start_year'] = int(years[0])
+    doc['block_starts'] = [series.index[i].isoformat() for i in bounds[:-1]]
+    doc['blocks'] = [values[lo: hi].tobytes() for lo, hi in zip(bounds[:-1], bounds[1:])]
+    return doc
+
+
+def encode_rollups(series, dtype='float64'):
+    """Encode the coarse resolution rollups of daily performance data.
+
+    Parameters
+    ----------
+    series: pd.Series or None
+        Daily performance data.
+    dtype: str
+        Storage dtype passed to `encode_performance`.
+
+    Returns
+    -------
+    rollups: dict
+        {resolution: {smoother: encoded document}} for every resolution coarser than daily.  Smoothers that fail
+        on the series (e.g. too short for a seasonal decomposition) are stored empty.
+    """
+    if not isinstance(series, (pd.Series, pd.DataFrame)) or len(series) == 0:
+        series = None
+    resolutions = [i for i in RESOLUTIONS if i != 'daily']
+    rollups = {resolution: {} for resolution in resolutions}
+    for smoother in SMOOTHERS:
+        try:
+            smoothed = deg.smooth(series, smoother) if series is not None else None
+        except ValueError:
+            smoothed = None
+        for resolution in resolutions:
+            rollup = resample_performance(smoothed, resolution) if smoothed is not None else None
+            rollups[resolution][smoother] = encode_performance(rollup, dtype)
+    return rollups
+
+
+def decode_performance(raw):
+    """Decode a `performance` field into a time series.
+
+    Values are wrapped with np.frombuffer, so for version 1 and single block documents the returned series shares
+    read-only memory with the raw document.  Multi-year version 2 documents are copied once, when their blocks are
+    joined (a single memcpy, which is small next to the query itself).  Documents whose blocks were sliced by a date-range query
+    decode to the corresponding part of the series.
+
+    Parameters
+    ----------
+    raw: dict or bytes
+        Columnar document written by `encode_performance` or a legacy pickled blob.
+
+    Returns
+    -------
+    series: pd.Series or object
+        Decoded time series (legacy blobs return whatever was pickled).
+    """
+    if isinstance(raw, (bytes, bytearray)):
+        return pickle.loads(raw)
+
+    version = raw.get('version')
+    dtype = np.dtype(raw['dtype'])
+    if version == 1:
+        values = np.frombuffer(raw['values'], dtype=dtype)
+        start = raw['start']
+    elif version == 2:
+        blocks = raw['blocks']
+        values = np.frombuffer(blocks[0] if len(blocks) == 1 else b''.join(blocks), dtype=dtype)
+        start = raw['block_starts'][0] if raw['block_starts'] else None
+    else:
+        raise ValueError('Unsupported performance encoding version: {}'.format(version))
+
+    return make_series(values, start, raw['freq'], raw['tz'], raw['name'])
+
+
+def encoded_size(raw):
+    """Number of encoded data bytes in a `performance` field (as read from the database).
+
+    Parameters
+    ----------
+    raw: dict or bytes
+        Columnar document or legacy pickled blob.
+
+    Returns
+    -------
+    nbytes: int
+    """
+    if isinstance(raw, (bytes, bytearray)):
+        return len(raw)
+    if isinstance(raw, dict):
+        return sum(len(i) for i in raw.get('blocks') or []) + len(raw.get('values') or b'')
+    return 0
+
+
+def index_header(series):
+    """Describe the regular time index of a series.
+
+    Parameters
+    ----------
+    series: pd.Series
+        Non-empty series with a regular DatetimeIndex.
+
+    Returns
+    -------
+    header: dict
+        'start' (ISO format), 'freq', 'tz' and 'name' of the series.
+    """
+    freq = series.index.freqstr or pd.infer_freq(series.index)
+    if freq is None:
+        raise ValueError('Performance data must have a regular frequency to be encoded.')
+    return {'start': series.index[0].isoformat(), 'freq': freq,
+            'tz': str(series.index.tz) if series.index.tz is not None else None,
+            'name': series.name if series.name is None else str(series.name)}
+
+
+def make_series(values, start, freq, tz=None, name=None):
+    """Wrap an array in a series with a regular time index, without copying it.
+
+    Parameters
+    ----------
+    values: np.ndarray
+    start: str or None
+        First timestamp (ISO format), None for empty series.
+    freq: str
+    tz: str or None
+    name: str or None
+
+    Returns
+    -------
+    series: pd.Series
+    """
+    return pd.Series(values, index=make_index(start, len(values), freq, tz), name=name)
+
+
+def make_index(start, length, freq, tz=None):
+    """Build a regular time index.
+
+    Parameters
+    ----------
+    start: str or None
+        First timestamp (ISO format), None for empty indices.
+    length: int
+    freq: str
+    tz: str or None
+
+    Returns
+    -------
+    index: pd.DatetimeIndex
+    """
+    if length == 0:
+        return pd.DatetimeIndex([], tz=tz)
+    start = pd.Timestamp(start)
+    if tz is not None:
+        start = start.tz_convert(tz)
+    return pd.date_range(start=start, periods=length, freq=freq)
+
+
+def range_pipeline(ids, field, start=None, end=None):
+    """Build an aggregation pipeline returning only the yearly blocks that overlap [start, end].
+
+    Documents that are not block encoded (legacy pickles) are passed through whole under 'legacy'.
+
+    Parameters
+    ----------
+    ids: list
+        System ID values.
+    field: str
+        Field holding encoded data (see `rollup_field`).
+    start, end: pd.Timestamp or None
+        Requested date range.
+
+    Returns
+    -------
+    pipeline: list
+        Aggregation stages; each output document has 'ID', 'data' and 'legacy' keys.
+    """
+    ref = '$' + field
+    is_blocked = {'$isArray': ref + '.blocks'}
+    if start is not None:
+        first = {'$max': [0, {'$subtract': [start.year, ref + '.start_year']}]}
+    else:
+        first = 0
+    if end is not None:
+        n_blocks = {'$max': [1, {'$subtract': [{'$add': [end.year, 1]},
+                                               {'$add': [ref + '.start_year', first]}]}]}
+    else:
+        n_blocks = 10000
+
+    def sliced(name):
+        return {'$cond': [is_blocked, {'$slice': [ref + '.' + name, first, n_blocks]}, None]}
+
+    data = {'version': ref + '.version', 'dtype': ref + '.dtype', 'freq': ref + '.freq', 'tz': ref + '.tz',
+            'name': ref + '.name', 'blocks': sliced('blocks'), 'block_starts': sliced('block_starts')}
+    return [{'$match': {'ID': {'$in': ids}}},
+            {'$project': {'_id': 0, 'ID': 1, 'data': data, 'legacy': {'$cond': [is_blocked, None, ref]}}}]
+
+
+def migrate_performance(collection, dtype='float64', batch_size=100):
+    """Rewrite legacy (pickled or older versions) `performance` fields in the current encoding.
+
+    Documents missing any rollup are also rewritten; rollups are recomputed and `updated_at` is bumped for every
+    migrated document.
+
+    Parameters
+    ----------
+    collection: pymongo collection
+        Collection holding system documents.
+    dtype: str
+        Storage dtype passed to `encode_performance`.
+    batch_size: int
+        Number of documents updated per bulk write.
+
+    Returns
+    -------
+    n_migrated: int
+        Number of documents rewritten.
+    """
+    missing_rollups = [{rollup_field(resolution, smoother): {'$exists': False}}
+                       for resolution in RESOLUTIONS if resolution != 'daily' for smoother in SMOOTHERS]
+    query = {'performance': {'$exists': True},
+             '$or': [{'performance.version': {'$ne': FORMAT_VERSION}}] + missing_rollups}
+    cursor = collection.find(query, {'_id': 1, 'performance': 1}, batch_size=batch_size)
+
+    n_migrated = 0
+    updates = []
+    for doc in cursor:
+        series = decode_performance(doc['performance'])
+        if not isinstance(series, (pd.Series, pd.DataFrame)):
+            series = None
+        updates.append(UpdateOne({'_id': doc['_id']}, {'$set': {'performance': encode_performance(series, dtype),
+                                                                'rollups': encode_rollups(series, dtype),
+                                                                'updated_at': datetime.datetime.utcnow()}}))
+        if len(updates) >= batch_size:
+            n_migrated += collection.bulk_write(updates, ordered=False).modified_count
+            updates = []
+    if updates:
+        n_migrated += collection.bulk_write(updates, ordered=False).modified_count
+
+    return n_migrated
@@ -0,0 +1,108 @@
+"""
+Streaming export of performance data for the /export endpoint.
+
+Systems are fetched `chunk_size` at a time through DBHandler.get_system_data (bypassing the caches) and written
+out in long format (ID, date, performance) as each chunk arrives, so only one chunk is ever held in memory.
+"""
+
+import io
+import collections
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+
+FORMATS = {'csv': ('text/csv', 'csv'), 'parquet': ('application/octet-stream', 'parquet')}
+
+COLUMNS = ['ID', 'date', 'performance']
+
+
+def long_frame(system_id, series):
+    """Convert a system time series to long format.
+
+    Parameters
+    ----------
+    system_id: int
+    series: pd.Series
+        Performance data (time zone aware indexes are written as local time).
+
+    Returns
+    -------
+    df: pd.DataFrame
+        Columns ID, date and performance.
+    """
+    if isinstance(series, pd.DataFrame):
+        series = series.iloc[:, 0]
+    index = series.index
+    if getattr(index, 'tz', None) is not None:
+        index = index.tz_localize(None)
+    return pd.DataFrame({'ID': system_id, 'date': index, 'performance': series.values}, columns=COLUMNS)
+
+
+def iter_chunks(db_handler, ids, start=None, end=None, resolution='daily', chunk_size=50):
+    """Fetch systems in chunks.
+
+    Parameters
+    ----------
+    db_handler: DBHandler
+    ids: list
+        System ID values (duplicates are exported once).
+    start, end: str, datetime or None
+        Date range.
+    resolution: str
+        'daily', 'weekly' or 'monthly'.
+    chunk_size: int
+        Number of systems per fetch.
+
+    Yields
+    ------
+    df: pd.DataFrame
+        Long format data of the systems of one chunk (in request order).
+    """
+    ids = list(collections.OrderedDict.fromkeys(ids))
+    for i in range(0, len(ids), chunk_size):
+        systems = db_handler.get_system_data(ids[i: i + chunk_size], start=start, end=end, resolution=resolution)
+        frames = [long_frame(system_id, systems[system_id]) for system_id in ids[i: i + chunk_size]
+                  if system_id in systems and len(systems[system_id])]
+        if frames:
+            yield pd.concat(frames, ignore_index=True)
+
+
+def iter_csv(db_handler, ids, **kwargs):
+    """Stream CSV text, one piece per chunk of systems (see `iter_chunks` for arguments)."""
+    yield ','.join(COLUMNS) + '\n'
+    for df in iter_chunks(db_handler, ids, **kwargs):
+        yield df.to_csv(header=False, index=False)
+
+
+def iter_parquet(db_handler, ids, **kwargs):
+    """Stream a Parquet file, one row group per chunk of systems (see `iter_chunks` for arguments).
+
+    Requires pyarrow.
+    """
+    if pq is None:
+        raise ImportError('Parquet export requires pyarrow')
+    buf = io.BytesIO()
+    schema = pa.schema([pa.field('ID', pa.int64()), pa.field('date', pa.timestamp('ns')),
+                        pa.field('performance', pa.float64())])
+    writer = pq.ParquetWriter(buf, schema)
+    for df in iter_chunks(db_handler, ids, **kwargs):
+        df['ID'] = df['ID'].astype('int64')
+        df['performance'] = df['performance'].astype('float64')
+        writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+        yield _drain(buf)
+    writer.close()
+    yield _drain(buf)
+
+
+def _drain(buf):
+    """Return and discard the bytes written to a buffer so far."""
+    data = buf.getvalue()
+    buf.seek(0)
+    buf.truncate()
+    return data
@@ -0,0 +1,121 @@
+"""
+Lightweight counters and histograms for the data layer.
+
+Each storage backend owns a Metrics instance (shared with its DBHandler) recording query and decode times and the
+number of encoded bytes read; `DBHandler.stats` combines it with the cache counters for the /metrics endpoint.
+"""
+
+import time
+import bisect
+import functools
+import threading
+import contextlib
+import collections
+
+
+# bucket upper bounds
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BYTES_BUCKETS = tuple(2 ** i for i in range(10, 31, 2))
+
+
+class Histogram(object):
+    """
+    Bucketed histogram of observed values (bucket counts are not cumulative).
+    """
+
+    def __init__(self, buckets=SECONDS_BUCKETS):
+        """Create instance.
+
+        Parameters:
+        ----------
+        buckets: tuple
+            Sorted upper bounds of the buckets; larger values fall in a final overflow bucket.
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = value if self.max is None else max(self.max, value)
+
+    def snapshot(self):
+        """Report the histogram.
+
+        Returns
+        -------
+        snapshot: dict
+            Count, sum, mean, max and {upper bound: count} buckets ('inf' for the overflow bucket).
+        """
+        bounds = [str(i) for i in self.buckets] + ['inf']
+        return {'count': self.count, 'sum': self.sum, 'mean': self.sum / self.count if self.count else None,
+                'max': self.max, 'buckets': collections.OrderedDict(zip(bounds, self.counts))}
+
+
+class Metrics(object):
+    """
+    Thread-safe registry of named counters and histograms.
+    """
+
+    def __init__(self):
+        self.counters = collections.defaultdict(float)
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, value=1):
+        """Add to a counter."""
+        with self._lock:
+            self.counters[name] += value
+
+    def observe(self, name, value, buckets=SECONDS_BUCKETS):
+        """Record a value in a histogram (created with `buckets` on first use)."""
+        with self._lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(buckets)
+            self.histograms[name].observe(value)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """Record the duration of a block, in seconds, in a histogram."""
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - t0)
+
+    def snapshot(self):
+        """Report all counters and histograms.
+
+        Returns
+        -------
+        snapshot: dict
+        """
+        with self._lock:
+            return {'counters': dict(self.counters),
+                    'histograms': {name: h.snapshot() for name, h in self.histograms.items()}}
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+def timed(name):
+    """Method decorator recording call durations in the `metrics` attribute of the instance.
+
+    Parameters
+    ----------
+    name: str
+        Histogram name.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.timer(name):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
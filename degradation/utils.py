@@ -1,11 +1,30 @@
 
 
 import os
+import sys
+import glob
+import json
+import time
+import pickle
+import hashlib
+import logging
+import threading
 import collections
+import datetime
+import concurrent.futures as cf
 
 import pandas as pd
 import numpy as np
-import pickle
+
+from .backends import METADATA_FIELDS, MongoBackend, StorageBackend
+from .encoding import index_header, make_rollup, make_series, rollup_field, slice_performance
+from .metrics import Metrics, timed
+
+
+logger = logging.getLogger(__name__)
+
+# zoom level from which the map shows every system individually
+POINTS_ZOOM = 9
 
 
 def make_filler():
@@ -35,37 +54,949 @@ def make_hovers(df):
     df: pd.DataFrame
         Input dataframe plus the 'text' column.
     """
-    texts = []
-    for idx, x in df.iterrows():
-        texts.append(
-            '{0} -- {1}<br>{2}, {3}<br>{4}W system<br>Active for {5} days'.format(x['ID'], x['system_name'],
-                                                                                  x['county'], x['state (abbr)'],
-                                                                                  x['system_size (W)'],
-                                                                                  x['active_days'])
-        )
-    df['text'] = texts
+    df['text'] = (df['ID'].astype(str) + ' -- ' + df['system_name'].astype(str) + '<br>' +
+                  df['county'].astype(str) + ', ' + df['state (abbr)'].astype(str) + '<br>' +
+                  df['system_size (W)'].astype(str) + 'W system<br>Active for ' +
+                  df['active_days'].astype(str) + ' days')
     return df
 
 
+def axis_range(relayout_data, axis='xaxis'):
+    """Read the zoomed range of a graph axis.
+
+    Parameters
+    ----------
+    relayout_data: dict or None
+        `relayoutData` property of a dcc.Graph.
+    axis: str
+        'xaxis' or 'yaxis'.
+
+    Returns
+    -------
+    lo, hi: object
+        Visible axis range as sent by plotly, (None, None) when the axis is not zoomed.
+    """
+    if not relayout_data or relayout_data.get(axis + '.autorange'):
+        return None, None
+    if axis + '.range[0]' in relayout_data and axis + '.range[1]' in relayout_data:
+        return relayout_data[axis + '.range[0]'], relayout_data[axis + '.range[1]']
+    if axis + '.range' in relayout_data:
+        return tuple(relayout_data[axis + '.range'])
+    return None, None
+
+
+def zoom_range(relayout_data):
+    """Read the zoomed date range of a graph.
+
+    Parameters
+    ----------
+    relayout_data: dict or None
+        `relayoutData` property of a dcc.Graph.
+
+    Returns
+    -------
+    start, end: pd.Timestamp or None
+        Visible x-axis range, (None, None) when the graph is not zoomed.
+    """
+    lo, hi = axis_range(relayout_data, 'xaxis')
+    if lo is None or hi is None:
+        return None, None
+    try:
+        return pd.Timestamp(lo), pd.Timestamp(hi)
+    except ValueError:
+        return None, None
+
+
+def zoom_rows(relayout_data, n_rows):
+    """Read the rows visible on a zoomed numeric y-axis where row i is drawn at y = i.
+
+    Parameters
+    ----------
+    relayout_data: dict or None
+        `relayoutData` property of a dcc.Graph.
+    n_rows: int
+        Number of rows.
+
+    Returns
+    -------
+    first, stop: int
+        Positions of the first visible row and one past the last (0, n_rows when the axis is not zoomed).
+    """
+    lo, hi = axis_range(relayout_data, 'yaxis')
+    try:
+        lo, hi = sorted([float(lo), float(hi)])
+    except (TypeError, ValueError):
+        return 0, n_rows
+    first = min(max(0, int(np.ceil(lo - .5))), n_rows - 1)
+    stop = max(min(n_rows, int(np.floor(hi + .5)) + 1), first + 1)
+    return first, stop
+
+
+def lod_resolution(start=None, end=None, smoother='raw', max_columns=1000):
+    """Pick the coarsest stored resolution that still fills a heatmap of `max_columns` time cells.
+
+    Parameters
+    ----------
+    start, end: pd.Timestamp or None
+        Displayed date range (None for the full history, shown weekly).
+    smoother: str
+        Smoothed data is never read daily (it is not stored at that resolution).
+    max_columns: int
+        Time cell budget.
+
+    Returns
+    -------
+    resolution: str
+        'daily', 'weekly' or 'monthly'.
+    """
+    if start is None or end is None:
+        return 'weekly'
+    days = (end - start).days + 1
+    if days <= max_columns and smoother == 'raw':
+        return 'daily'
+    if days <= 7 * max_columns:
+        return 'weekly'
+    return 'monthly'
+
+
+def bin_rows(df, max_rows):
+    """Average groups of consecutive rows so that at most `max_rows` remain.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+    max_rows: int
+
+    Returns
+    -------
+    df: pd.DataFrame
+        Binned frame, indexed by the first label of each bin (the input itself if it is small enough).
+    step: int
+        Number of input rows per bin.
+    """
+    step = int(np.ceil(len(df) / float(max_rows))) if len(df) > max_rows else 1
+    if step == 1:
+        return df, step
+    binned = df.groupby(np.arange(len(df)) // step).mean()
+    binned.index = df.index[::step]
+    return binned, step
+
+
+def cluster_systems(metadata, zoom, cell_pixels=40):
+    """Group systems that fall in the same map grid cell at a zoom level.
+
+    Parameters
+    ----------
+    metadata: pd.DataFrame
+        System metadata with 'latitude (deg)', 'longitude (deg)', 'ID', 'text' and 'Size (W)' columns.
+    zoom: int
+        Mapbox zoom level.  From POINTS_ZOOM on, every system is its own cluster.
+    cell_pixels: int
+        Width of a grid cell on screen.
+
+    Returns
+    -------
+    clusters: pd.DataFrame
+        One row per non-empty cell: mean latitude and longitude, 'count' of systems, and the 'ID', 'text' and
+        'Size (W)' of its first system (only meaningful for single-system cells).
+    """
+    columns = ['latitude (deg)', 'longitude (deg)', 'ID', 'text', 'Size (W)']
+    metadata = metadata[columns].dropna(subset=['latitude (deg)', 'longitude (deg)'])
+    if zoom >= POINTS_ZOOM:
+        clusters = metadata.reset_index(drop=True)
+        clusters['count'] = 1
+        return clusters
+
+    # degrees per cell (mapbox tiles are 512 px wide)
+    cell = 360. * cell_pixels / (512 * 2 ** zoom)
+    grouped = metadata.groupby([np.floor(metadata['latitude (deg)'].values / cell),
+                                np.floor(metadata['longitude (deg)'].values / cell)], sort=False)
+    clusters = grouped[['latitude (deg)', 'longitude (deg)']].mean()
+    clusters['count'] = grouped.size()
+    for col in ['ID', 'text', 'Size (W)']:
+        clusters[col] = grouped[col].first()
+    return clusters.reset_index(drop=True)
+
+
+def visible_points(clusters, zoom, center=None, width=1200, height=480):
+    """Drop clusters far outside the map viewport.
+
+    Parameters
+    ----------
+    clusters: pd.DataFrame
+        Output of `cluster_systems`.
+    zoom: float
+        Mapbox zoom level.
+    center: dict or None
+        Map center ({'lat': .., 'lon': ..}); None keeps every cluster.
+    width, height: int
+        Approximate viewport size in pixels.  A margin of one viewport is kept on each side, so small pans do not
+        show empty areas.
+
+    Returns
+    -------
+    clusters: pd.DataFrame
+    """
+    if center is None:
+        return clusters
+    span = 360. / (512 * 2 ** zoom)
+    lon_margin, lat_margin = 1.5 * width * span, 1.5 * height * span
+    if lon_margin >= 180:
+        return clusters
+    mask = (((clusters['longitude (deg)'] - center['lon']).abs() <= lon_margin) &
+            ((clusters['latitude (deg)'] - center['lat']).abs() <= lat_margin))
+    return clusters[mask]
+
+
+def sort_positions(metadata, column, ascending=True):
+    """Row positions of metadata sorted by a column (stable, missing values last).
+
+    Parameters
+    ----------
+    metadata: pd.DataFrame
+    column: str
+    ascending: bool
+
+    Returns
+    -------
+    positions: np.ndarray
+    """
+    values = metadata[column].reset_index(drop=True)
+    return values.sort_values(ascending=ascending, kind='mergesort', na_position='last').index.values
+
+
+def search_text(metadata):
+    """Lower-case text searched by metadata table filters.
+
+    Parameters
+    ----------
+    metadata: pd.DataFrame
+
+    Returns
+    -------
+    text: pd.Series
+        One string per system (ID, name, state, county and climate), aligned with the rows of metadata.
+    """
+    text = metadata['ID'].astype(str)
+    for col in ['system_name', 'State', 'County', 'Climate']:
+        text = text + ' ' + metadata[col].astype(str)
+    return text.str.lower().reset_index(drop=True)
+
+
+def box_stats(df, keys, columns):
+    """Box-plot statistics of several columns per group, computed in one grouped pass.
+
+    Whiskers end at the most extreme values within 1.5 IQR of the quartiles (as drawn by plotly); values beyond
+    them are outliers.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+    keys: pd.Series
+        Group label of each row of df (rows with missing labels are dropped).
+    columns: list
+        Columns of df to summarize.
+
+    Returns
+    -------
+    stats: dict
+        Dictionary with {column: pd.DataFrame} format, one row per group (in sorted group order) with q1, median,
+        q3, lowerfence, upperfence and outliers (list) columns; groups without values are left out.
+    """
+    keys = pd.Series(np.asarray(keys), index=df.index)
+    data = df.loc[keys.notnull(), columns].astype(float)
+    keys = keys[keys.notnull()]
+    grouped = data.groupby(keys)
+    q1, median, q3 = grouped.quantile(.25), grouped.quantile(.5), grouped.quantile(.75)
+
+    # fences of each row's group, for all columns at once
+    iqr = q3 - q1
+    low = (q1 - 1.5 * iqr).reindex(keys.values).values
+    high = (q3 + 1.5 * iqr).reindex(keys.values).values
+    inside = (data.values >= low) & (data.values <= high)
+    lowerfence = data.where(inside).groupby(keys).min()
+    upperfence = data.where(inside).groupby(keys).max()
+    outside = data.where(~inside).stack().dropna()
+    outliers = outside.groupby([keys.reindex(outside.index.get_level_values(0)).values,
+                                outside.index.get_level_values(1)]).apply(list)
+
+    stats = {}
+    for col in columns:
+        summary = pd.DataFrame({'q1': q1[col], 'median': median[col], 'q3': q3[col],
+                                'lowerfence': np.minimum(lowerfence[col], q1[col]),
+                                'upperfence': np.maximum(upperfence[col], q3[col])},
+                               columns=['q1', 'median', 'q3', 'lowerfence', 'upperfence']).dropna()
+        summary['outliers'] = [outliers.get((group, col), []) for group in summary.index]
+        stats[col] = summary
+    return stats
+
+
+def box_sample(q1, median, q3, lowerfence, upperfence, outliers=()):
+    """Short sample of values that plotly draws as the box of the given statistics.
+
+    plotly (2.x) cannot draw boxes from precomputed statistics, so each statistic is repeated in a run long enough
+    that any quartile interpolation lands inside it; the sample size grows with the number of outliers only.
+
+    Parameters
+    ----------
+    q1, median, q3: float
+        Quartiles.
+    lowerfence, upperfence: float
+        Whisker ends.
+    outliers: list
+        Values beyond the whiskers.
+
+    Returns
+    -------
+    sample: list
+    """
+    low = sorted(i for i in outliers if i < lowerfence)
+    high = sorted(i for i in outliers if i > upperfence)
+    pad = max(len(low), len(high)) + 1
+    run = max(4, int(np.ceil((pad + 2) / 1.5)))
+    return (low + [lowerfence] * (pad - len(low)) + [q1] * run + [median] * run + [q3] * run +
+            [upperfence] * (pad - len(high)) + high)
+
+
+def memory_usage(obj):
+    """Estimate the memory footprint of a cached object.
+
+    Parameters
+    ----------
+    obj: object
+        Usually a pd.Series or pd.DataFrame, but any python object is accepted.
+
+    Returns
+    -------
+    nbytes: int
+        Size of the object in bytes (deep, including the index for pandas objects).
+    """
+    try:
+        usage = obj.memory_usage(index=True, deep=True)
+    except (AttributeError, TypeError):
+        return sys.getsizeof(obj)
+    return int(np.sum(usage))
+
+
+class RateDistributions(object):
+    """
+    Exact empirical distributions of degradation rates, precomputed once per metadata frame.
+
+    For each method the fleet's rates are sorted once, and every system records the rank of its rate.  The ECDF of a
+    selection is then the sorted ranks of the selected systems, indexed into the sorted rates: O(k log k) for k
+    systems, independent of the fleet size.  Population distributions per State and Climate are kept as sorted arrays.
+    """
+
+    methods = ('ols_rd', 'csd_rd', 'yoy_rd')
+    groups = ('State', 'Climate')
+
+    def __init__(self, metadata):
+        """Create instance.
+
+        Parameters:
+        ----------
+        metadata: pd.DataFrame
+            System metadata (see DBHandler.get_system_metadata).
+        """
+        self.index = pd.Index(metadata['ID'].values)
+        self.sorted = {}
+        self.ranks = {}
+        for method in self.methods:
+            values = metadata[method].values.astype(float)
+            valid = np.flatnonzero(~np.isnan(values))
+            order = valid[np.argsort(values[valid], kind='mergesort')]
+            self.sorted[method] = values[order]
+            ranks = np.full(len(values), -1, dtype=int)
+            ranks[order] = np.arange(len(order))
+            self.ranks[method] = ranks
+
+        self.codes = {}
+        self.categories = {}
+        self.group_sorted = {}
+        for column in self.groups:
+            values = metadata[column].astype('category')
+            self.codes[column] = values.cat.codes.values
+            self.categories[column] = list(values.cat.categories)
+            for method in self.methods:
+                ranks = self.ranks[method]
+                for code, group in enumerate(self.categories[column]):
+                    group_ranks = np.sort(ranks[(self.codes[column] == code) & (ranks >= 0)])
+                    self.group_sorted[(column, group, method)] = self.sorted[method][group_ranks]
+
+    def values(self, method, ids=None, column=None, group=None):
+        """Sorted rates of a set of systems.
+
+        Parameters
+        ----------
+        method: str
+            'ols_rd', 'csd_rd' or 'yoy_rd'.
+        ids: list-like or None
+            System ID values (None for the whole fleet).  Unknown IDs and missing rates are skipped.
+        column, group: str or None
+            Restrict to systems with metadata[column] == group ('State' or 'Climate').
+
+        Returns
+        -------
+        values: np.ndarray
+            Rates in increasing order.
+        """
+        if ids is None:
+            if column is None:
+                return self.sorted[method]
+            return self.group_sorted.get((column, group, method), np.array([]))
+        positions = self.index.get_indexer(list(ids))
+        positions = np.unique(positions[positions >= 0])
+        if column is not None:
+            code = self.categories[column].index(group) if group in self.categories[column] else -2
+            positions = positions[self.codes[column][positions] == code]
+        ranks = self.ranks[method][positions]
+        return self.sorted[method][np.sort(ranks[ranks >= 0])]
+
+    def ecdf(self, method, ids=None, column=None, group=None):
+        """Empirical cumulative distribution of rates (see `values` for arguments).
+
+        Returns
+        -------
+        x: np.ndarray
+            Sorted rates.
+        y: np.ndarray
+            Fraction of systems with a rate lower or equal to x.
+        """
+        x = self.values(method, ids, column, group)
+        return x, np.arange(1, len(x) + 1) / float(max(len(x), 1))
+
+
+class LRUCache(object):
+    """
+    Least-recently-used cache bounded by entry count and by memory footprint.
+
+    All operations hold an internal lock, so an instance can be shared by request threads.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=128 * 2 ** 20):
+        """Create instance.
+
+        Parameters:
+        ----------
+        max_entries: int or None
+            Maximum number of cached objects (None for no limit).
+        max_bytes: int or None
+            Maximum total size of cached objects in bytes, measured with `memory_usage` (None for no limit).
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data = collections.OrderedDict()
+        self._sizes = {}
+        self._lock = threading.RLock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._data
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def __getitem__(self, key):
+        with self._lock:
+            value = self._data[key]
+            self._data.move_to_end(key)
+            return value
+
+    def __setitem__(self, key, value):
+        nbytes = memory_usage(value)
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            if self.max_bytes is not None and nbytes > self.max_bytes:
+                # never worth flushing the whole cache for a single oversized entry
+                return
+            self._data[key] = value
+            self._sizes[key] = nbytes
+            self.nbytes += nbytes
+            self._evict()
+
+    def get(self, key, default=None):
+        """Look up a key and record the hit or miss.
+
+        Parameters
+        ----------
+        key: hashable
+        default: object
+            Returned when key is not cached.
+
+        Returns
+        -------
+        value: object
+        """
+        with self._lock:
+            try:
+                value = self[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return value
+
+    def keys(self):
+        with self._lock:
+            return list(self._data.keys())
+
+    def drop(self, keys):
+        """Remove keys (missing keys are ignored).
+
+        Parameters
+        ----------
+        keys: iterable
+
+        Returns
+        -------
+        n_dropped: int
+        """
+        n_dropped = 0
+        with self._lock:
+            for key in keys:
+                if key in self._data:
+                    self._remove(key)
+                    n_dropped += 1
+        return n_dropped
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._sizes.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Report cache counters.
+
+        Returns
+        -------
+        stats: dict
+            Hits, misses, evictions, current size and configured limits.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self._data), 'nbytes': self.nbytes,
+                    'max_entries': self.max_entries, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'hit_rate': self.hits / lookups if lookups else None}
+
+    def _remove(self, key):
+        del self._data[key]
+        self.nbytes -= self._sizes.pop(key)
+
+    def _evict(self):
+        while self._data and ((self.max_entries is not None and len(self._data) > self.max_entries) or
+                              (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+            key = next(iter(self._data))
+            self._remove(key)
+            self.evictions += 1
+
+
+class DiskCache(object):
+    """
+    Read-through cache of decoded performance data on local disk, shared by every worker process on a host.
+
+    Each series is stored as a .npy file, loaded memory-mapped, next to a .json header describing its time index.
+    File names include the version of the system document, so updated documents are never served stale.
+    """
+
+    def __init__(self, directory):
+        """Create instance.
+
+        Parameters:
+        ----------
+        directory: str
+            Cache directory (created if needed).
+        """
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+
+    def _path(self, key, version):
+        system_id, resolution, smoother = key
+        return os.path.join(self.directory, str(system_id), '{}-{}-{}'.format(resolution, smoother, version))
+
+    def get(self, key, version):
+        """Read a cached series.
+
+        Parameters
+        ----------
+        key: tuple
+            (system_id, resolution, smoother)
+        version: int
+            Version of the system document.
+
+        Returns
+        -------
+        series: pd.Series or None
+            Series backed by a read-only memory map, None if not cached.
+        """
+        path = self._path(key, version)
+        try:
+            with open(path + '.json') as f:
+                header = json.load(f)
+            if header['length']:
+                values = np.load(path + '.npy', mmap_mode='r')
+            else:
+                values = np.array([], dtype=header['dtype'])
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return make_series(values, header['start'], header['freq'], header['tz'], header['name'])
+
+    def put(self, key, version, series):
+        """Write a series to the cache, replacing older versions.
+
+        Files are written under temporary names and renamed, so concurrent readers never see partial data.
+
+        Parameters
+        ----------
+        key: tuple
+            (system_id, resolution, smoother)
+        version: int
+            Version of the system document.
+        series: pd.Series
+        """
+        if not isinstance(series, pd.Series):
+            return
+        if len(series):
+            try:
+                header = index_header(series)
+            except ValueError:
+                return
+        else:
+            header = {'start': None, 'freq': None, 'tz': None, 'name': None}
+        header['length'] = len(series)
+        header['dtype'] = series.dtype.str
+
+        path = self._path(key, version)
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(tmp, 'w') as f:
+                json.dump(header, f)
+            os.replace(tmp, path + '.json')
+            with open(tmp, 'wb') as f:
+                np.save(f, np.ascontiguousarray(series.values))
+            os.replace(tmp, path + '.npy')
+        except OSError:
+            # another worker is rewriting or removing the same entry
+            return
+
+        for fname in glob.glob(self._path(key, '*') + '.*'):
+            file_version = os.path.basename(fname).split('.')[0].rsplit('-', 1)[-1]
+            try:
+                if int(file_version) < version:
+                    os.remove(fname)
+            except (ValueError, OSError):
+                pass
+
+    def stats(self):
+        """Report cache counters.
+
+        Returns
+        -------
+        stats: dict
+        """
+        return {'directory': self.directory, 'hits': self.hits, 'misses': self.misses}
+
+
+class ResultCache(object):
+    """
+    Cache of callback results with a time-to-live, optionally backed by a directory shared by all worker processes.
+    """
+
+    def __init__(self, max_entries=256, ttl=600, shared_dir=None):
+        """Create instance.
+
+        Parameters:
+        ----------
+        max_entries: int or None
+            Maximum number of results held in memory.
+        ttl: float or None
+            Seconds a result stays valid (None for no expiry).
+        shared_dir: str or None
+            Directory where results are also pickled, so other workers can reuse them.  Results that cannot be
+            pickled are only cached in memory.
+        """
+        self.ttl = ttl
+        self._memory = LRUCache(max_entries=max_entries, max_bytes=None)
+        self.shared_dir = shared_dir
+        self._writes = 0
+        # types of results that failed to pickle (warned about once)
+        self._unpicklable = set()
+        if shared_dir:
+            os.makedirs(shared_dir, exist_ok=True)
+
+    def get(self, key, default=None):
+        """Look up a result.
+
+        Parameters
+        ----------
+        key: tuple
+            Hashable key with a stable repr (ints, floats, strings and tuples of these).
+        default: object
+            Returned when no valid result is cached.
+
+        Returns
+        -------
+        value: object
+        """
+        entry = self._memory.get(key)
+        if entry is not None and (entry[0] is None or entry[0] > time.time()):
+            return entry[1]
+        if self.shared_dir:
+            path = self._path(key)
+            try:
+                expires = os.path.getmtime(path) + self.ttl if self.ttl is not None else None
+                if expires is None or expires > time.time():
+                    with open(path, 'rb') as f:
+                        value = pickle.load(f)
+                    self._memory[key] = (expires, value)
+                    return value
+            except (IOError, OSError, EOFError, pickle.UnpicklingError):
+                pass
+        return default
+
+    def __setitem__(self, key, value):
+        expires = time.time() + self.ttl if self.ttl is not None else None
+        self._memory[key] = (expires, value)
+        if self.shared_dir:
+            path = self._path(key)
+            tmp = '{}.{}.tmp'.format(path, os.getpid())
+            try:
+                with open(tmp, 'wb') as f:
+                    pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(tmp, path)
+            except OSError:
+                logger.exception('Could not share cached result')
+            except (pickle.PicklingError, TypeError, AttributeError) as e:
+                name = type(value).__name__
+                if name not in self._unpicklable:
+                    self._unpicklable.add(name)
+                    logger.warning('Results of type %s cannot be shared between workers: %s', name, e)
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+            self._writes += 1
+            if self.ttl is not None and self._writes % 100 == 0:
+                self._prune()
+
+    def stats(self):
+        """Report cache counters (of the in-memory tier).
+
+        Returns
+        -------
+        stats: dict
+        """
+        return dict(self._memory.stats(), ttl=self.ttl, shared_dir=self.shared_dir)
+
+    def _path(self, key):
+        return os.path.join(self.shared_dir, hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.pkl')
+
+    def _prune(self):
+        """Remove expired shared results."""
+        for fname in glob.glob(os.path.join(self.shared_dir, '*.pkl')):
+            try:
+                if os.path.getmtime(fname) + self.ttl < time.time():
+                    os.remove(fname)
+            except OSError:
+                pass
+
+
 class DBHandler(object):
     """
-    Handle calls to MongoDB for degradation analysis.
+    Handle calls to the data store (MongoDB by default) for degradation analysis.
     """
 
-    def __init__(self, collection):
+    def __init__(self, backend, cache_entries=1000, cache_bytes=128 * 2 ** 20, chunk_size=50, max_workers=4,
+                 disk_cache_dir=None, prefetch_workers=2, prefetch_limit=50, smoothing_workers=0,
+                 smoothing_timeout=60):
         """Create instance.
 
         Parameters:
         ----------
-        collection: pymongo collection
-            Time-series performance data.
+        backend: StorageBackend, pymongo collection or function
+            Storage of metadata and time-series performance data (see backends.py).  A collection, or a function
+            returning the collection (called on first use, so the handler can be created before the database is
+            reachable), is wrapped in a MongoBackend.
+        cache_entries: int or None
+            Maximum number of systems held in the performance data cache.
+        cache_bytes: int or None
+            Maximum memory (in bytes) used by the performance data cache.
+        chunk_size: int
+            Number of systems requested per query when fetching large selections.
+        max_workers: int
+            Number of threads issuing chunk queries concurrently.  With a MongoBackend all threads share the
+            connection pool of the collection's MongoClient.
+        disk_cache_dir: str or None
+            Directory of an optional on-disk cache tier (see DiskCache) below the in-memory cache.
+        prefetch_workers: int
+            Number of background threads loading systems for `prefetch`.
+        prefetch_limit: int
+            Maximum number of systems loaded per `prefetch` call.
+        smoothing_workers: int
+            Number of processes smoothing and resampling systems without stored rollups.  The process pool is
+            opt-in (0 or 1 smooths on `max_workers` threads): once rollups are stored (see migrate_performance) it
+            would sit idle, and every server process gets its own pool, so pass the cores available per worker.
+        smoothing_timeout: float or None
+            Seconds to wait for the smoothing of a chunk of systems; systems not done by then are reported in
+            `errors`.
         """
 
-        self.collection = collection
-        self.cache = collections.OrderedDict()
+        self.backend = backend if isinstance(backend, StorageBackend) else MongoBackend(backend)
+        if self.backend.metrics is None:
+            self.backend.metrics = Metrics()
+        # query, decode and call timings, shared with the backend
+        self.metrics = self.backend.metrics
+        self.cache = LRUCache(max_entries=cache_entries, max_bytes=cache_bytes)
+        self.chunk_size = chunk_size
+        self.executor = cf.ThreadPoolExecutor(max_workers=max_workers)
+        self.disk_cache = DiskCache(disk_cache_dir) if disk_cache_dir else None
         self.metadata = None
+        self.versions = {}
+        self.last_update = None
+        self._metadata_lock = threading.Lock()
+        # fetches in progress, {cache key: concurrent.futures.Future}
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        # values derived from the current metadata frame (map clusters, table sort orders), see `_derived`
+        self._derived_cache = {}
+        self.prefetch_executor = cf.ThreadPoolExecutor(max_workers=prefetch_workers)
+        self.prefetch_limit = prefetch_limit
+        # pending prefetch chunks, {group: [concurrent.futures.Future]}
+        self._prefetches = {}
+        self._prefetch_lock = threading.Lock()
+        self._stop_refresh = threading.Event()
+        self.smoothing_workers = smoothing_workers
+        self.smoothing_timeout = smoothing_timeout
+        self.smoothing_executor = cf.ThreadPoolExecutor(max_workers=max_workers)
+        self._smoothing_pool = None
+        self._smoothing_pid = None
+        # recent smoothing failures, {(system_id, resolution, smoother): message}
+        self.errors = LRUCache(max_entries=1000, max_bytes=None)
+        self.status = {'stage': 'pending', 'done': 0, 'total': 0, 'error': None}
+
+    @property
+    def smoothing_pool(self):
+        """Process pool smoothing systems without stored rollups, (re)created in each process."""
+        if self._smoothing_pool is None or self._smoothing_pid != os.getpid():
+            if threading.active_count() > 1:
+                logger.warning('Starting the smoothing pool with %d threads running; forked workers may inherit '
+                               'held locks (call start_smoothing_pool first)', threading.active_count())
+            self._smoothing_pool = cf.ProcessPoolExecutor(max_workers=self.smoothing_workers)
+            self._smoothing_pid = os.getpid()
+        return self._smoothing_pool
+
+    def start_smoothing_pool(self):
+        """Fork the smoothing processes now.
+
+        On Linux the pool forks the current process, and a child inherits any lock (logging, stdout, metrics) held
+        by another thread at that moment, which can hang it.  Call this before starting any thread (warm-up,
+        metadata refresh, chunk fetches, the server itself).  One overlapping task per worker is submitted, so
+        the pool forks every process now whether it starts them all at once or on demand (Python 3.9+).
+        """
+        if self.smoothing_workers > 1:
+            cf.wait([self.smoothing_pool.submit(time.sleep, .1) for _ in range(self.smoothing_workers)])
+
+    @property
+    def ready(self):
+        """Whether metadata is loaded and warm-up has finished."""
+        return self.status['stage'] == 'ready'
+
+    def warm_up(self, n_systems=0, resolution='weekly', smoother='raw'):
+        """Load metadata and prefill the cache, reporting progress in `self.status`.
+
+        A failed warm-up is not retried; the handler becomes ready as soon as metadata is loaded by a later page
+        request or refresh (the cache then fills on demand).
+
+        Parameters
+        ----------
+        n_systems: int
+            Number of systems (in metadata order) whose performance data is loaded into the cache.
+        resolution: str
+            Resolution of the prefetched data.
+        smoother: str
+            Smoother of the prefetched data.
+        """
+        try:
+            self.status.update(stage='metadata', done=0, total=0, error=None)
+            metadata = self.get_system_metadata()
+
+            ids = list(metadata['ID'][:n_systems])
+            self.status.update(stage='cache', total=len(ids))
+            for i in range(0, len(ids), self.chunk_size):
+                chunk = ids[i: i + self.chunk_size]
+                self.get_system_data(chunk, allow_add=True, resolution=resolution, smoother=smoother)
+                self.status['done'] += len(chunk)
+            self.status['stage'] = 'ready'
+        except Exception as e:
+            logger.exception('Warm-up failed')
+            self.status.update(stage='failed', error=str(e))
+
+    def start_warm_up(self, **kwargs):
+        """Run `warm_up` on a background thread.
+
+        Parameters
+        ----------
+        kwargs:
+            Passed to `warm_up`.
+        """
+        thread = threading.Thread(target=self.warm_up, kwargs=kwargs, name='warm-up', daemon=True)
+        thread.start()
+
+    def prefetch(self, points, group='default', resolution='weekly', smoother='raw', chunk_size=10):
+        """Start loading systems into the cache in the background, ahead of a likely request.
+
+        Prefetches of the same group replace each other: chunks of the previous call that have not started are
+        cancelled.  Chunks already running complete, and a request for the same systems waits on them instead of
+        querying again (see `get_system_data`).
+
+        Parameters
+        ----------
+        points: list-like
+            System ID values, most likely first (only the first `prefetch_limit` are loaded).
+        group: str
+            Source of the prefetch (e.g. 'map' or 'table').
+        resolution, smoother: str
+            As in `get_system_data`.
+        chunk_size: int
+            Number of systems per background task (smaller chunks cancel sooner).
+
+        Returns
+        -------
+        futures: list
+            One concurrent.futures.Future per chunk.
+        """
+        points = [int(i) for i in points][:self.prefetch_limit]
+        to_load = [i for i in points if self._cache_key(i, resolution, smoother) not in self.cache]
+        with self._prefetch_lock:
+            for future in self._prefetches.get(group, []):
+                future.cancel()
+            futures = [self.prefetch_executor.submit(self._prefetch_chunk, to_load[i: i + chunk_size],
+                                                     resolution, smoother)
+                       for i in range(0, len(to_load), chunk_size)]
+            self._prefetches[group] = futures
+        self.metrics.incr('prefetched_systems', len(to_load))
+        return futures
+
+    def _prefetch_chunk(self, ids, resolution, smoother):
+        try:
+            self.get_system_data(ids, allow_add=True, resolution=resolution, smoother=smoother)
+        except Exception:
+            logger.exception('Prefetch failed')
 
-    def get_system_data(self, points, allow_add=False):
+    @timed('get_system_data_seconds')
+    def get_system_data(self, points, allow_add=False, start=None, end=None, resolution='daily', smoother='raw'):
         """Query for system-specific performance data.
 
         Parameters:
@@ -73,32 +1004,231 @@ class DBHandler(object):
         points: list-like
             List of unique system_id values (*not* mongo _id values).
         allow_add: bool
-            Add new entries to a cache to avoid repetitive queries.
+            Add new entries to the memory and disk caches to avoid repetitive queries (one-off reads such as
+            exports leave them alone).
+        start, end: str, datetime or None
+            Only return data in the (inclusive) date range.  The range is applied server-side on whole years
+            and trimmed exactly after decoding.
+        resolution: str
+            'daily', 'weekly' or 'monthly'.  Weekly and monthly data come from rollups stored with each system.
+        smoother: str
+            'raw', 'rolling' or 'csd' (see degradation_functions.smooth).  Smoothed data is read from the stored
+            rollups, or computed from the full daily history when no rollup is available.
 
         Returns
         -------
         systems: dict
-            Dictionary with {system_id: time-series dataframe} format.
+            Dictionary with {system_id: time-series dataframe} format.  Systems without data, or for which
+            smoothing failed, are left out.
         """
 
         points = [int(i) for i in points]
-        to_retrieve = [i for i in points if i not in self.cache]
-
-        tmp_systems = {}
-        if to_retrieve:
-            res = pd.DataFrame(list(self.collection.find({'ID': {'$in': to_retrieve}}, {'ID': 1, 'performance': 1, '_id': 0})))
-            for idx, df in zip(res['ID'], res['performance']):
-                tmp_systems[idx] = pickle.loads(df)
-
-        if allow_add:
-            for idx in tmp_systems:
-                self.cache[idx] = tmp_systems[idx]
-            ret_dict = {i: self.cache[i] for i in points}
+        start = pd.Timestamp(start) if start is not None else None
+        end = pd.Timestamp(end) if end is not None else None
+        rollup_field(resolution, smoother)
+
+        # entries are keyed by document version, so data of updated systems is never served from the cache
+        keys = {i: self._cache_key(i, resolution, smoother, start, end) for i in points}
+        ret_dict = {}
+        for i in points:
+            if i not in ret_dict:
+                df = self._cache_lookup(keys[i])
+                if df is not None:
+                    ret_dict[i] = df
+
+        # single-flight: IDs already being fetched by another request are waited on instead of queried again
+        to_retrieve, waiting, claimed = [], {}, {}
+        with self._inflight_lock:
+            for i in points:
+                if i in ret_dict or i in waiting or i in claimed:
+                    continue
+                if keys[i] in self._inflight:
+                    waiting[i] = self._inflight[keys[i]]
+                else:
+                    claimed[i] = self._inflight[keys[i]] = cf.Future()
+                    to_retrieve.append(i)
+
+        try:
+            tmp_systems = self._load(to_retrieve, resolution, smoother, start, end, allow_add) if to_retrieve else {}
+            if allow_add:
+                for idx in tmp_systems:
+                    # a metadata refresh during the fetch may have updated the system, its data is then stale
+                    if keys[idx][1] == self.versions.get(idx):
+                        self.cache[keys[idx]] = tmp_systems[idx]
+        except Exception as e:
+            for future in claimed.values():
+                future.set_exception(e)
+            raise
         else:
-            tmp_dict = {**self.cache, **tmp_systems}
-            ret_dict = {i: tmp_dict[i] for i in points}
+            for i, future in claimed.items():
+                future.set_result(tmp_systems.get(i))
+        finally:
+            with self._inflight_lock:
+                for i in claimed:
+                    del self._inflight[keys[i]]
+        ret_dict.update(tmp_systems)
+
+        for i, future in waiting.items():
+            df = future.result()
+            if df is not None:
+                ret_dict[i] = df
+
+        return {i: ret_dict[i] for i in points if i in ret_dict}
+
+    def _load(self, ids, resolution, smoother, start, end, allow_add=False):
+        """Read systems from the disk cache, or fetch them from the backend in concurrent chunks.
 
-        return ret_dict
+        Fetched full histories are written to the disk cache if `allow_add`.
+
+        Returns
+        -------
+        systems: dict
+            Dictionary with {system_id: time-series} format.
+        """
+        systems = {}
+        to_retrieve = ids
+        if self.disk_cache is not None:
+            for i in ids:
+                df = self._disk_lookup(i, resolution, smoother, start, end)
+                if df is not None:
+                    systems[i] = df
+            to_retrieve = [i for i in ids if i not in systems]
+
+        fetched = {}
+        if len(to_retrieve) <= self.chunk_size:
+            if to_retrieve:
+                fetched = self._fetch_chunk(to_retrieve, resolution, smoother, start, end)
+        else:
+            chunks = [to_retrieve[i: i + self.chunk_size] for i in range(0, len(to_retrieve), self.chunk_size)]
+            futures = [self.executor.submit(self._fetch_chunk, chunk, resolution, smoother, start, end)
+                       for chunk in chunks]
+            for future in cf.as_completed(futures):
+                fetched.update(future.result())
+
+        if self.disk_cache is not None and allow_add and start is None and end is None:
+            for idx, df in fetched.items():
+                version = self.versions.get(idx)
+                if version is not None:
+                    self.disk_cache.put((idx, resolution, smoother), version, df)
+        systems.update(fetched)
+        return systems
+
+    def _cache_key(self, system_id, resolution, smoother, start=None, end=None):
+        """Memory cache key of a system, tagged with its document version (see `versions`)."""
+        return system_id, self.versions.get(system_id), resolution, smoother, start, end
+
+    def _cache_lookup(self, key):
+        """Look up cached data, slicing a cached full history if the exact range is not cached."""
+        full_key = key[:4] + (None, None)
+        start, end = key[4:]
+        if key not in self.cache and full_key in self.cache:
+            df = self.cache.get(full_key)
+            if df is not None:
+                return slice_performance(df, start, end)
+        return self.cache.get(key)
+
+    def _disk_lookup(self, system_id, resolution, smoother, start, end):
+        """Look up the full history of a system in the disk cache and slice it to the requested range."""
+        if self.metadata is None:
+            self.get_system_metadata()
+        version = self.versions.get(system_id)
+        if version is None:
+            return None
+        df = self.disk_cache.get((system_id, resolution, smoother), version)
+        return slice_performance(df, start, end)
+
+    def _fetch_chunk(self, ids, resolution='daily', smoother='raw', start=None, end=None):
+        """Query and decode performance data for a group of systems.
+
+        Documents are decoded as the cursor yields them, so the raw result set is never held in memory at once.
+
+        Parameters
+        ----------
+        ids: list
+            System ID values.
+        resolution: str
+            Requested resolution (see `get_system_data`).
+        smoother: str
+            Requested smoother (see `get_system_data`).
+        start, end: pd.Timestamp or None
+            Requested date range.
+
+        Returns
+        -------
+        systems: dict
+            Dictionary with {system_id: time-series} format.
+        """
+        field = rollup_field(resolution, smoother)
+        if field is not None:
+            systems, missing = self.backend.query_performance(ids, field, start, end)
+        else:
+            systems, missing = {}, ids
+        if missing and field != 'performance':
+            # rollups are not stored for these systems (or smoothed daily data was requested), compute them from
+            # the daily data -- smoothers need the full history to avoid edge effects
+            if smoother == 'raw':
+                daily, missing = self.backend.query_performance(missing, 'performance', start, end)
+            else:
+                daily, missing = self.backend.query_performance(missing, 'performance')
+            with self.metrics.timer('rollup_seconds'):
+                rollups = self._make_rollups(daily, resolution, smoother)
+            for idx, series in rollups.items():
+                systems[idx] = slice_performance(series, start, end)
+        return systems
+
+    def _make_rollups(self, daily, resolution, smoother):
+        """Smooth and resample daily performance data, on the smoothing process pool (if enabled) or on threads.
+
+        Systems that fail or are not done within `smoothing_timeout` are left out, logged and recorded in
+        `errors`.
+
+        Parameters
+        ----------
+        daily: dict
+            Dictionary with {system_id: daily time-series} format (full history).
+        resolution: str
+        smoother: str
+
+        Returns
+        -------
+        systems: dict
+            Dictionary with {system_id: time-series} format.
+        """
+        systems = {}
+        failed = {}
+        pool = self.smoothing_pool if self.smoothing_workers > 1 and len(daily) > 1 else self.smoothing_executor
+        futures = {pool.submit(make_rollup, df, resolution, smoother): idx for idx, df in daily.items()}
+        done, not_done = cf.wait(futures, timeout=self.smoothing_timeout)
+        for future in done:
+            try:
+                systems[futures[future]] = future.result()
+            except Exception as e:
+                failed[futures[future]] = '{}: {}'.format(type(e).__name__, e)
+        for future in not_done:
+            # running tasks cannot be interrupted, but queued ones are dropped
+            future.cancel()
+            failed[futures[future]] = 'timed out after {} s'.format(self.smoothing_timeout)
+
+        for idx, message in failed.items():
+            logger.warning('Could not smooth system %s (%s, %s): %s', idx, resolution, smoother, message)
+            self.errors[(idx, resolution, smoother)] = message
+        self.metrics.incr('smoothing_errors', len(failed))
+        return systems
+
+    def stats(self):
+        """Report data layer counters for monitoring.
+
+        Returns
+        -------
+        stats: dict
+            Warm-up status, memory and disk cache counters (hits, misses, evictions, size), and backend
+            counters and histograms (query, decode and call times in seconds, bytes read).
+        """
+        return {'status': dict(self.status),
+                'memory_cache': self.cache.stats(),
+                'disk_cache': self.disk_cache.stats() if self.disk_cache is not None else None,
+                'inflight': len(self._inflight),
+                'metrics': self.metrics.snapshot()}
 
     def get_system_metadata(self):
         """Get metadata of all systems.
@@ -106,16 +1236,213 @@ class DBHandler(object):
         Returns
         -------
         metadata: pd.DataFrame
-            Dataframe includes latitude, longitude, system_id, and public_name.
+            Dataframe includes latitude, longitude, system_id, and public_name, indexed by system ID.  State,
+            County and Climate are categorical.
         """
         if self.metadata is None:
-            fields = {'ID': 1, 'system_size (W)': 1, 'latitude (deg)': 1, 'longitude (deg)': 1, 'system_name': 1, '_id': 0,
-                      'state (abbr)': 1, 'county': 1, 'active_days': 1, 'climate': 1, 'csd_rd': 1, 'yoy_rd': 1, 'ols_rd': 1}
-            metadata = pd.DataFrame(list(self.collection.find({}, fields)))
-            self.metadata = make_hovers(metadata)
-            self.metadata = self.metadata.rename(columns={'system_size (W)': 'Size (W)', 'state (abbr)': 'State',
-                                                          'county': 'County', 'climate': 'Climate', 'active_days': 'Active Days'})
+            with self._metadata_lock:
+                if self.metadata is None:
+                    self._set_metadata(self._load_metadata())
         return self.metadata
+
+    def map_clusters(self, zoom):
+        """Get map clusters at a zoom level, computed once per integer level and metadata frame.
+
+        Parameters
+        ----------
+        zoom: float
+            Mapbox zoom level.
+
+        Returns
+        -------
+        clusters: pd.DataFrame
+            See `cluster_systems`.
+        """
+        level = int(min(max(zoom, 0), POINTS_ZOOM))
+        return self._derived(('clusters', level), lambda metadata: cluster_systems(metadata, level))
+
+    def metadata_page(self, query='', sort_by='ID', ascending=True, page=0, page_size=20):
+        """Filter, sort and page the metadata table.
+
+        Sort orders and the text searched by filters are computed once per metadata frame, so a request only costs
+        a vectorized match over the fleet (when filtering) and the selection of one page.
+
+        Parameters
+        ----------
+        query: str
+            Whitespace-separated terms, each matched (case-insensitively) against ID, name, state, county and
+            climate of a system.  Systems must match every term.
+        sort_by: str
+            Metadata column.
+        ascending: bool
+            Sort order (missing values always come last).
+        page: int
+            Page number, starting at 0 (clipped to the available pages).
+        page_size: int
+            Number of rows per page.
+
+        Returns
+        -------
+        rows: pd.DataFrame
+            Metadata of the systems on the page.
+        total: int
+            Number of systems matching the query.
+        """
+        metadata = self.get_system_metadata()
+        order = self._derived(('order', sort_by, ascending), lambda m: sort_positions(m, sort_by, ascending))
+        terms = (query or '').lower().split()
+        if terms:
+            search = self._derived('search', search_text)
+            mask = np.ones(len(search), dtype=bool)
+            for term in terms:
+                mask &= search.str.contains(term, regex=False).values
+            order = order[mask[order]]
+        total = len(order)
+        page = int(min(max(page, 0), max(total - 1, 0) // page_size))
+        return metadata.iloc[order[page * page_size: (page + 1) * page_size]], total
+
+    def _derived(self, key, func):
+        """Get a value derived from the current metadata frame, computing it once per frame.
+
+        Parameters
+        ----------
+        key: hashable
+            Name of the value.
+        func: function
+            Computes the value from the metadata frame.
+
+        Returns
+        -------
+        value: object
+        """
+        metadata = self.get_system_metadata()
+        derived = self._derived_cache
+        if derived.get('metadata') is not metadata:
+            derived = self._derived_cache = {'metadata': metadata}
+        if key not in derived:
+            derived[key] = func(metadata)
+        return derived[key]
+
+    def rate_distributions(self):
+        """Get sorted degradation rate distributions of the current metadata (see RateDistributions).
+
+        Returns
+        -------
+        distributions: RateDistributions
+        """
+        return self._derived('rates', RateDistributions)
+
+    def select_metadata(self, ids):
+        """Get metadata of some systems.
+
+        Lookups go through the ID index, so the cost depends on the number of systems requested rather than on the
+        fleet size.  Column dtypes are preserved and systems with missing metadata fields are kept.
+
+        Parameters
+        ----------
+        ids: list-like
+            System ID values.  Unknown IDs are skipped and duplicates are returned once.
+
+        Returns
+        -------
+        metadata: pd.DataFrame
+            Rows of the requested systems, in request order.
+        """
+        metadata = self.get_system_metadata()
+        index = metadata.index
+        ids = [i for i in collections.OrderedDict.fromkeys(int(i) for i in ids) if i in index]
+        return metadata.loc[ids]
+
+    @timed('refresh_metadata_seconds')
+    def refresh_metadata(self):
+        """Pull metadata of systems added or updated since the last load and patch it in.
+
+        Only documents with an `updated_at` later than the newest one already loaded are queried.  The patched
+        frame replaces the current one in a single assignment, so readers see either the old or the new frame.
+        Cached performance data of the updated systems is dropped from memory; memory and disk cache entries are
+        keyed by document version, so data fetched before the refresh is never served after it.  Deleted documents are not detected (they disappear on the next
+        full load).
+
+        Returns
+        -------
+        n_changed: int
+            Number of systems added or updated.
+        """
+        if self.metadata is None:
+            self.get_system_metadata()
+            return len(self.metadata)
+
+        with self._metadata_lock:
+            old = self.metadata
+            changed = self._load_metadata(self.last_update or datetime.datetime(1970, 1, 1))
+            if changed.empty:
+                return 0
+
+            order = list(old.index) + [i for i in changed.index if i not in old.index]
+            metadata = pd.concat([old[~old.index.isin(changed.index)], changed]).loc[order]
+            self._set_metadata(metadata)
+        changed_ids = set(changed.index)
+        self.cache.drop([key for key in self.cache.keys() if key[0] in changed_ids])
+        return len(changed)
+
+    def start_metadata_refresh(self, interval):
+        """Refresh metadata on a background thread.
+
+        Parameters
+        ----------
+        interval: float
+            Seconds between refreshes.
+        """
+        def refresh_loop():
+            while not self._stop_refresh.wait(interval):
+                try:
+                    self.refresh_metadata()
+                except Exception:
+                    logger.exception('Metadata refresh failed')
+
+        thread = threading.Thread(target=refresh_loop, name='metadata-refresh', daemon=True)
+        thread.start()
+
+    def stop_metadata_refresh(self):
+        """Stop the background refresh started by `start_metadata_refresh`."""
+        self._stop_refresh.set()
+
+    @timed('load_metadata_seconds')
+    def _load_metadata(self, updated_since=None):
+        """Query metadata and format it for the dashboard.
+
+        Parameters
+        ----------
+        updated_since: datetime or None
+            Only load systems updated after this (None for all systems).
+
+        Returns
+        -------
+        metadata: pd.DataFrame
+        """
+        metadata = self.backend.query_metadata(METADATA_FIELDS, updated_since)
+        if metadata.empty:
+            return metadata
+        metadata = make_hovers(metadata)
+        metadata = metadata.rename(columns={'system_size (W)': 'Size (W)', 'state (abbr)': 'State',
+                                            'county': 'County', 'climate': 'Climate', 'active_days': 'Active Days'})
+        # index by system ID (the 'ID' column is kept) for cheap lookups
+        metadata.index = pd.Index(metadata['ID'].values)
+        return metadata
+
+    def _set_metadata(self, metadata):
+        """Finalize dtypes, update document versions and publish a new metadata frame."""
+        for col in ['State', 'County', 'Climate']:
+            metadata[col] = metadata[col].astype('category')
+        if 'updated_at' in metadata and metadata['updated_at'].notnull().any():
+            # document versions key the disk cache
+            self.versions = {i: pd.Timestamp(t).value for i, t in zip(metadata['ID'], metadata['updated_at'])
+                             if pd.notnull(t)}
+            self.last_update = pd.Timestamp(metadata['updated_at'].max()).to_pydatetime()
+        self.metadata = metadata
+        if self.status['stage'] == 'failed':
+            # warm-up failed (e.g. the database was unreachable at boot), the prefill is only an optimization
+            self.status.update(stage='ready', error=None)
 #
 # class DBHandler(object):
 #     """
@@ -1,21 +1,28 @@
 
 
+import os
 import base64
 
+import pandas as pd
+
+from flask import Response, jsonify, request, stream_with_context
 from dash.dependencies import Input, Output
 import dash_core_components as dcc
 import dash_html_components as html
 import dash_table_experiments as dt
 
-from app import app, client
-from misc.misc_pages import serve_header, serve_error
+from app import app, auth, server, get_client
+from misc.misc_pages import serve_header, serve_error, serve_loading
 
 from clearsky import cs_dashboard
 from clearsky import callbacks as cs_callbacks
 
 from degradation import deg_dashboard
 from degradation import callbacks as deg_callbacks
-from degradation.utils import DBHandler
+from degradation import export as deg_export
+from degradation.backends import HDF5Backend, MongoBackend
+from degradation.encoding import rollup_field
+from degradation.utils import DBHandler, ResultCache
 
 
 encoded_logo = base64.b64encode(open('./images/duramat_logo.png', 'rb').read())
@@ -86,6 +93,8 @@ app.layout = html.Div([
               [Input('url', 'pathname')])
 def display_page(pathname):
     if pathname == '/degradation':
+        if deg_db_handler.metadata is None and deg_db_handler.status['stage'] in ('pending', 'metadata'):
+            return serve_loading(deg_db_handler.status)
         return deg_dashboard.serve_layout(deg_db_handler)
     elif pathname == '/clearsky':
         return cs_dashboard.serve_layout()
@@ -93,12 +102,95 @@ def display_page(pathname):
         return layout
 
 
-deg_db_handler = DBHandler(client.pvdata.appdata)
-deg_callbacks.add_callbacks(app, deg_db_handler)
+# performance data cache limits (per worker)
+cache_entries = int(os.environ.get('DURAMAT_CACHE_MAX_ENTRIES', 1000))
+cache_bytes = int(float(os.environ.get('DURAMAT_CACHE_MAX_MB', 128)) * 2 ** 20)
+# optional on-disk cache shared by all workers of a host
+disk_cache_dir = os.environ.get('DURAMAT_DISK_CACHE_DIR')
+# serve from a local HDF5 snapshot (see db_update/make_snapshot.py) instead of MongoDB when given
+hdf5_snapshot = os.environ.get('DURAMAT_HDF5_SNAPSHOT')
+if hdf5_snapshot:
+    deg_backend = HDF5Backend(hdf5_snapshot)
+else:
+    deg_backend = MongoBackend(lambda: get_client().pvdata.appdata)
+# processes smoothing systems without stored rollups, per gunicorn worker (0 smooths on threads); only worth
+# enabling while rollups are not stored yet (see db_update/migrate_performance.py)
+smoothing_workers = int(os.environ.get('DURAMAT_SMOOTHING_WORKERS', 0))
+deg_db_handler = DBHandler(deg_backend, cache_entries=cache_entries, cache_bytes=cache_bytes,
+                           disk_cache_dir=disk_cache_dir, smoothing_workers=smoothing_workers)
+# fork the smoothing processes before any thread starts
+deg_db_handler.start_smoothing_pool()
+# figures of repeated selections are reused for DURAMAT_RESULT_CACHE_TTL seconds; DURAMAT_RESULT_CACHE_DIR shares
+# them between the workers of a host
+result_cache = ResultCache(max_entries=int(os.environ.get('DURAMAT_RESULT_CACHE_ENTRIES', 256)),
+                           ttl=float(os.environ.get('DURAMAT_RESULT_CACHE_TTL', 600)),
+                           shared_dir=os.environ.get('DURAMAT_RESULT_CACHE_DIR'))
+deg_callbacks.add_callbacks(app, deg_db_handler, result_cache)
+
+# load metadata (and optionally prefill the cache) in the background so the server binds right away;
+# DURAMAT_LAZY_STARTUP=0 loads everything before serving
+warmup_systems = int(os.environ.get('DURAMAT_WARMUP_SYSTEMS', 0))
+if os.environ.get('DURAMAT_LAZY_STARTUP', '1') == '1':
+    deg_db_handler.start_warm_up(n_systems=warmup_systems)
+else:
+    deg_db_handler.warm_up(n_systems=warmup_systems)
+
+# pick up newly ingested or updated systems without a restart (0 disables)
+metadata_refresh = float(os.environ.get('DURAMAT_METADATA_REFRESH_SECONDS', 600))
+if metadata_refresh > 0:
+    deg_db_handler.start_metadata_refresh(metadata_refresh)
 
 cs_callbacks.add_callbacks(app)
 
 
+@server.route('/ready')
+def ready():
+    """Report warm-up progress (HTTP 503 until the dashboard is ready)."""
+    status = dict(deg_db_handler.status)
+    status['ready'] = deg_db_handler.ready
+    return jsonify(status), 200 if status['ready'] else 503
+
+
+@server.route('/metrics')
+def metrics():
+    """Report cache hit rates and data layer timings as JSON."""
+    if not auth.is_authorized():
+        return auth.login_request()
+    return jsonify(dict(deg_db_handler.stats(), result_cache=result_cache.stats()))
+
+
+@server.route('/export', methods=['GET', 'POST'])
+def export():
+    """Stream performance data of selected systems as CSV or Parquet.
+
+    Parameters (query string, form or JSON body): ids (list or comma-separated string), start, end,
+    resolution ('daily', 'weekly' or 'monthly') and format ('csv' or 'parquet').
+    """
+    if not auth.is_authorized():
+        return auth.login_request()
+    params = request.get_json(silent=True) or request.values
+    ids = params.get('ids') or []
+    if not isinstance(ids, list):
+        ids = ids.split(',')
+    fmt = params.get('format', 'csv')
+    try:
+        ids = [int(i) for i in ids]
+        kwargs = {key: pd.Timestamp(params[key]) if params.get(key) else None for key in ['start', 'end']}
+        kwargs.update(resolution=params.get('resolution', 'daily'), chunk_size=deg_db_handler.chunk_size)
+        rollup_field(kwargs['resolution'])
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if fmt not in deg_export.FORMATS:
+        return jsonify({'error': 'Unknown format: {}'.format(fmt)}), 400
+    if fmt == 'parquet' and deg_export.pq is None:
+        return jsonify({'error': 'Parquet export is not available (pyarrow is not installed)'}), 501
+
+    mimetype, extension = deg_export.FORMATS[fmt]
+    rows = deg_export.iter_csv if fmt == 'csv' else deg_export.iter_parquet
+    return Response(stream_with_context(rows(deg_db_handler, ids, **kwargs)), mimetype=mimetype,
+                    headers={'Content-Disposition': 'attachment; filename=performance.{}'.format(extension)})
+
+
 if __name__ == '__main__':
     # app.run_server(threaded=True)
     app.run_server(debug=False, threaded=True)
@@ -45,3 +45,13 @@ def serve_error():
     ])
 
     return page
+
+
+def serve_loading(status):
+    page = html.Div([
+        serve_header(),
+        html.H1('Loading system data...'),
+        html.P('The dashboard is warming up ({}).  Please refresh the page in a few seconds.'.format(status['stage']))
+    ])
+
+    return page